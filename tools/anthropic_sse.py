@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Anthropic Messages 流式事件 (SSE) 编码器
+
+每个 content_block_delta 只有文本在变，事件的前后缀预先编码成 bytes，
+文本用 json 的 C 实现直接转义后拼接，不再每帧构造嵌套 dict 再 json.dumps。
+输出与 json.dumps 默认参数逐字节一致。
+
+直接运行本文件做微基准:  python anthropic_sse.py
+"""
+
+import json
+from functools import lru_cache
+from json.encoder import encode_basestring_ascii
+
+_MESSAGE_STOP = b'event: message_stop\ndata: {"type": "message_stop"}\n\n'
+
+
+def _quote(text: str) -> bytes:
+    # 与 json.dumps(ensure_ascii=True) 相同的转义，结果只含 ASCII
+    return encode_basestring_ascii(text).encode("ascii")
+
+
+@lru_cache(maxsize=64)
+def _delta_prefix(index: int, delta_type: str, field: str) -> bytes:
+    return (
+        f'event: content_block_delta\ndata: {{"type": "content_block_delta", "index": {index}, '
+        f'"delta": {{"type": "{delta_type}", "{field}": '
+    ).encode("ascii")
+
+
+_DELTA_SUFFIX = b"}}\n\n"
+
+
+def text_delta(text: str, index: int = 0) -> bytes:
+    return _delta_prefix(index, "text_delta", "text") + _quote(text) + _DELTA_SUFFIX
+
+
+def input_json_delta(partial_json: str, index: int) -> bytes:
+    return _delta_prefix(index, "input_json_delta", "partial_json") + _quote(partial_json) + _DELTA_SUFFIX
+
+
+def _event(name: str, data: dict) -> bytes:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("ascii")
+
+
+def message_start(msg_id: str, model: str, input_tokens: int = 0) -> bytes:
+    return _event("message_start", {
+        "type": "message_start",
+        "message": {
+            "id": msg_id, "type": "message", "role": "assistant", "content": [],
+            "model": model, "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+        },
+    })
+
+
+@lru_cache(maxsize=64)
+def content_block_start_text(index: int = 0) -> bytes:
+    return _event("content_block_start", {
+        "type": "content_block_start", "index": index, "content_block": {"type": "text", "text": ""},
+    })
+
+
+def content_block_start_tool_use(index: int, tool_id: str, name: str) -> bytes:
+    return _event("content_block_start", {
+        "type": "content_block_start", "index": index,
+        "content_block": {"type": "tool_use", "id": tool_id, "name": name, "input": {}},
+    })
+
+
+@lru_cache(maxsize=64)
+def content_block_stop(index: int = 0) -> bytes:
+    return _event("content_block_stop", {"type": "content_block_stop", "index": index})
+
+
+def message_delta(stop_reason: str, output_tokens: int) -> bytes:
+    return _event("message_delta", {
+        "type": "message_delta",
+        "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+        "usage": {"output_tokens": output_tokens},
+    })
+
+
+def message_stop() -> bytes:
+    return _MESSAGE_STOP
+
+
+def error(message: str, error_type: str = "api_error") -> bytes:
+    return _event("error", {"type": "error", "error": {"type": error_type, "message": message}})
+
+
+def _legacy_text_delta(text: str) -> str:
+    """改造前 chat_stream 的写法，仅用于基准对比"""
+    return f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': text}})}\n\n"
+
+
+def _bench():
+    import timeit
+
+    samples = {
+        "1 char": "x",
+        "100 chars": ("def f(x):\n    return {\"a\": x}  # 注释\n" * 3)[:100],
+        "4 KB": ("line with \"quotes\", tabs\t and 中文\n" * 200)[:4096],
+    }
+    print(f"{'delta':<10}{'json.dumps':>14}{'template':>14}{'speedup':>9}")
+    for label, text in samples.items():
+        assert text_delta(text) == _legacy_text_delta(text).encode("utf-8"), label
+        n = 200000 if len(text) < 1000 else 20000
+        old = min(timeit.repeat(lambda: _legacy_text_delta(text).encode("utf-8"), number=n, repeat=5)) / n
+        new = min(timeit.repeat(lambda: text_delta(text), number=n, repeat=5)) / n
+        print(f"{label:<10}{old * 1e9:>11.0f} ns{new * 1e9:>11.0f} ns{old / new:>8.1f}x")
+
+
+if __name__ == "__main__":
+    _bench()
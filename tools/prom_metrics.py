@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+极简的 Prometheus 指标 (文本格式导出)，不依赖 prometheus_client
+
+计数器和直方图按线程分条 (striped) 加锁: 每次更新只锁住
+当前线程对应的那一条，并发写几乎不互相等待；导出时再把各条汇总。
+"""
+
+import bisect
+import itertools
+import math
+import threading
+
+_STRIPES = 8
+_local = threading.local()
+_next_stripe = itertools.count()
+
+
+def _stripe() -> int:
+    # get_ident() 是按 64 字节对齐的 pthread 地址，直接取模总落在第 0 条；
+    # 改为每个线程首次更新时轮流分到一条
+    try:
+        return _local.stripe
+    except AttributeError:
+        _local.stripe = next(_next_stripe) % _STRIPES
+        return _local.stripe
+
+
+def _fmt(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        super().__init__(name, help_text, labelnames)
+        self._stripes = [({}, threading.Lock()) for _ in range(_STRIPES)]
+
+    def inc(self, amount: float = 1, *labelvalues):
+        values, lock = self._stripes[_stripe()]
+        with lock:
+            values[labelvalues] = values.get(labelvalues, 0) + amount
+
+    def labels(self, *labelvalues):
+        return _Bound(self, labelvalues)
+
+    def value(self, *labelvalues) -> float:
+        return sum(values.get(labelvalues, 0) for values, _ in self._stripes)
+
+    def render(self) -> list:
+        totals = {}
+        for values, lock in self._stripes:
+            with lock:
+                for key, v in values.items():
+                    totals[key] = totals.get(key, 0) + v
+        if not totals and not self.labelnames:
+            totals[()] = 0
+        return self._header() + [
+            f"{self.name}{_labels(self.labelnames, key)} {_fmt(v)}" for key, v in sorted(totals.items())
+        ]
+
+
+class _Bound:
+    def __init__(self, metric, labelvalues: tuple):
+        self._metric = metric
+        self._labelvalues = labelvalues
+
+    def inc(self, amount: float = 1):
+        self._metric.inc(amount, *self._labelvalues)
+
+    def observe(self, value: float):
+        self._metric.observe(value, *self._labelvalues)
+
+
+class Gauge(_Metric):
+    """可增减的瞬时值；也可以传 fn，在导出时现取"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn=None):
+        super().__init__(name, help_text)
+        self._value = 0
+        self._lock = threading.Lock()
+        self._fn = fn
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        self._value = value
+
+    def value(self) -> float:
+        if self._fn is not None:
+            try:
+                return self._fn()
+            except Exception:
+                return math.nan
+        return self._value
+
+    def render(self) -> list:
+        value = self.value()
+        return self._header() + [f"{self.name} {'NaN' if value != value else _fmt(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = ()):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每条: {labelvalues: [各桶计数..., +Inf 计数, sum]}
+        self._stripes = [({}, threading.Lock()) for _ in range(_STRIPES)]
+
+    def observe(self, value: float, *labelvalues):
+        i = bisect.bisect_left(self.buckets, value)
+        data, lock = self._stripes[_stripe()]
+        with lock:
+            row = data.get(labelvalues)
+            if row is None:
+                row = data[labelvalues] = [0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    def labels(self, *labelvalues):
+        return _Bound(self, labelvalues)
+
+    def _merged(self) -> dict:
+        merged = {}
+        for data, lock in self._stripes:
+            with lock:
+                for key, row in data.items():
+                    acc = merged.setdefault(key, [0] * len(row))
+                    for j, v in enumerate(row):
+                        acc[j] += v
+        return merged
+
+    def snapshot(self, *labelvalues) -> dict:
+        """返回 count / sum / 各桶累计数，便于测试和 JSON 输出"""
+        row = self._merged().get(labelvalues) or [0] * (len(self.buckets) + 2)
+        cumulative, running = {}, 0
+        for bound, n in zip(self.buckets + (math.inf,), row[:-1]):
+            running += n
+            cumulative[bound] = running
+        return {"count": running, "sum": row[-1], "buckets": cumulative}
+
+    def render(self) -> list:
+        lines = self._header()
+        merged = self._merged()
+        if not merged and not self.labelnames:
+            merged[()] = [0] * (len(self.buckets) + 2)
+        for key, row in sorted(merged.items()):
+            running = 0
+            for bound, n in zip(self.buckets + (math.inf,), row[:-1]):
+                running += n
+                le = 'le="' + _fmt(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_fmt(row[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {running}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        return self._add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name: str, help_text: str, fn=None) -> Gauge:
+        return self._add(Gauge(name, help_text, fn))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple, labelnames: tuple = ()) -> Histogram:
+        return self._add(Histogram(name, help_text, buckets, labelnames))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 常用的桶边界 (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
@@ -8,25 +8,1281 @@ import websocket
 import json
 import time
 import threading
-import queue
 import random
 import string
 import os
 import sys
 import re
+import asyncio
+import hashlib
+import signal
+import socket
+from collections import deque, OrderedDict
+
+import anthropic_sse as sse
+from prom_metrics import Registry, LATENCY_BUCKETS, DURATION_BUCKETS
+from token_counter import TokenCounter
+from response_cache import ResponseCache, cache_key
+from session_store import MemorySessionStore, SQLiteSessionStore
+import tool_calls
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # 仅 --async 模式需要
+    aiohttp = None
 
 app = Flask(__name__)
 
-class GensparkBridge:
-    def __init__(self, cookies: str):
-        self.ws_url = "wss://vear.com/conversation/go"
+# 指标 (Prometheus 文本格式，见 /metrics)
+METRICS = Registry()
+M_REQUESTS = METRICS.counter("proxy_requests_total", "Total /v1/messages requests")
+M_ERRORS = METRICS.counter("proxy_errors_total", "Errors by type", ("type",))
+M_ACTIVE = METRICS.gauge("proxy_active_streams", "Streams currently in flight")
+M_TTFT = METRICS.histogram("proxy_time_to_first_token_seconds", "Request start to first content delta", LATENCY_BUCKETS)
+M_GAP = METRICS.histogram("proxy_inter_chunk_gap_seconds", "Gap between consecutive content deltas", LATENCY_BUCKETS)
+M_DURATION = METRICS.histogram("proxy_stream_duration_seconds", "Total stream duration", DURATION_BUCKETS)
+M_CONTINUATIONS = METRICS.histogram("proxy_continuations_per_request", "Continuation rounds per request", (0, 1, 2, 3, 5, 10))
+M_CONT_GAP = METRICS.histogram("proxy_continuation_gap_seconds", "End of a segment to first delta of its continuation", LATENCY_BUCKETS)
+M_HANDSHAKE = METRICS.histogram("proxy_upstream_handshake_seconds", "Upstream WebSocket handshake time", LATENCY_BUCKETS)
+M_TOKENS = METRICS.counter("proxy_tokens_total", "Tokens by model and direction", ("model", "direction"))
+M_QUEUE_WAIT = METRICS.histogram("proxy_admission_wait_seconds", "Time spent queued before admission", LATENCY_BUCKETS)
+M_CACHE = METRICS.counter("proxy_response_cache_total", "Response cache lookups by result", ("result",))
+M_ACCOUNT_REQUESTS = METRICS.counter("proxy_account_requests_total", "Requests by upstream account and outcome", ("account", "outcome"))
+
+
+class UpstreamConnection:
+    """一条常驻的上游 WebSocket 连接，同一时刻只承载一个请求"""
+
+    def __init__(self, url: str, cookies: str, headers: list, ping_interval: int = 30):
+        self.opened = threading.Event()
+        self.closed = threading.Event()
+        self.handler = None  # 当前请求的帧回调
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.ping_interval = ping_interval
+        self.ws = websocket.WebSocketApp(
+            url,
+            cookie=cookies,
+            header=headers,
+            on_message=self._on_message,
+            on_error=self._on_error,
+            on_open=self._on_open,
+            on_close=self._on_close,
+        )
+        self.thread = None
+
+    def _on_open(self, ws):
+        self.opened.set()
+
+    def _on_message(self, ws, message):
+        handler = self.handler
+        if handler:
+            handler.on_message(message)
+
+    def _on_error(self, ws, error):
+        handler = self.handler
+        if handler:
+            handler.on_error(error)
+
+    def _on_close(self, ws, code, msg):
+        self.closed.set()
+        self.opened.set()  # 唤醒仍在等待握手的 open()
+        handler = self.handler
+        if handler:
+            handler.on_close()
+
+    def open(self, timeout: float):
+        self.thread = threading.Thread(
+            target=self.ws.run_forever,
+            kwargs={"ping_interval": self.ping_interval, "ping_timeout": 10},
+        )
+        self.thread.daemon = True
+        self.thread.start()
+        if not self.opened.wait(timeout) or self.closed.is_set():
+            self.close()
+            raise ConnectionError("上游握手失败")
+
+    @property
+    def alive(self) -> bool:
+        return (self.opened.is_set() and not self.closed.is_set()
+                and self.thread is not None and self.thread.is_alive())
+
+    def send(self, handler, payload: dict):
+        self.handler = handler
+        self.last_used = time.time()
+        self.ws.send(json.dumps(payload))
+
+    def close(self):
+        self.handler = None
+        self.closed.set()
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """有界的上游连接池：复用热连接、健康检查、退避重连、空闲回收
+
+    上游协议没有请求 id，一条连接同时只能跑一个请求，
+    因此"复用"是请求之间轮流使用已握手的连接。
+    """
+
+    def __init__(self, url: str, cookies: str, headers: list,
+                 max_size: int = 8, idle_timeout: float = 120,
+                 connect_timeout: float = 10, max_retries: int = 3,
+                 backoff_base: float = 0.5):
+        self.url = url
         self.cookies = cookies
-        self.uid = self._generate_uid()
-        
-        # 会话管理 - 复用对话
-        self.current_cid = None
+        self.headers = headers
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+
+        self._idle = deque()
+        self._size = 0  # 已创建(含使用中)的连接数
+        self._cond = threading.Condition()
+        self._closed = False
+        self._reaper = None
+
+    def prewarm(self) -> bool:
+        """没有空闲连接且还有余量时，在后台先握手一条，给紧接着的续写用"""
+        with self._cond:
+            if self._closed or self._idle or self._size >= self.max_size:
+                return False
+            self._size += 1
+        threading.Thread(target=self._prewarm, daemon=True).start()
+        return True
+
+    def _prewarm(self):
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        self.release(conn)
+
+    def acquire(self, timeout: float = 30) -> UpstreamConnection:
+        deadline = time.time() + timeout
+        stale = []
+        try:
+            with self._cond:
+                if self._reaper is None:
+                    # 首次使用时才启动回收线程，asyncio 模式下不会用到线程池
+                    self._reaper = threading.Thread(target=self._reap_loop)
+                    self._reaper.daemon = True
+                    self._reaper.start()
+                while True:
+                    if self._closed:
+                        raise ConnectionError("连接池已关闭")
+                    while self._idle:
+                        conn = self._idle.pop()  # 后进先出，优先用最热的连接
+                        if conn.alive:
+                            return conn
+                        self._size -= 1
+                        stale.append(conn)
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError(f"连接池已满 ({self.max_size})，等待超时")
+                    self._cond.wait(remaining)
+        finally:
+            for conn in stale:
+                conn.close()
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn: UpstreamConnection, reusable: bool = True):
+        conn.handler = None
+        with self._cond:
+            if reusable and conn.alive and not self._closed:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+            self._size -= 1
+            self._cond.notify()
+        conn.close()
+
+    def _connect(self) -> UpstreamConnection:
+        last_error = None
+        for attempt in range(self.max_retries):
+            if attempt:
+                delay = self.backoff_base * (2 ** (attempt - 1))
+                time.sleep(delay + random.uniform(0, delay / 2))
+            conn = UpstreamConnection(self.url, self.cookies, self.headers)
+            try:
+                started = time.monotonic()
+                conn.open(self.connect_timeout)
+                M_HANDSHAKE.observe(time.monotonic() - started)
+                return conn
+            except Exception as e:
+                last_error = e
+                print(f"[连接池] 握手失败 #{attempt + 1}: {e}", file=sys.stderr)
+        raise ConnectionError(f"上游连接失败: {last_error}")
+
+    def _reap_loop(self):
+        interval = max(1.0, self.idle_timeout / 2)
+        while not self._closed:
+            time.sleep(interval)
+            self.evict_idle()
+
+    def evict_idle(self):
+        """关闭空闲超时或已断开的连接"""
+        now = time.time()
+        evicted = []
+        with self._cond:
+            keep = deque()
+            for conn in self._idle:
+                if conn.alive and now - conn.last_used < self.idle_timeout:
+                    keep.append(conn)
+                else:
+                    evicted.append(conn)
+            self._idle = keep
+            self._size -= len(evicted)
+            if evicted:
+                self._cond.notify_all()
+        for conn in evicted:
+            conn.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"size": self._size, "idle": len(self._idle), "max_size": self.max_size}
+
+
+class AsyncConnectionPool:
+    """ConnectionPool 的 asyncio 版本，基于 aiohttp 客户端，不占用额外线程"""
+
+    def __init__(self, url: str, cookies: str, headers: list,
+                 max_size: int = 64, idle_timeout: float = 120,
+                 connect_timeout: float = 10, max_retries: int = 3,
+                 backoff_base: float = 0.5):
+        self.url = url
+        self.headers = dict(h.split(": ", 1) for h in headers)
+        self.headers["Cookie"] = cookies
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+
+        self._idle = deque()  # (ws, last_used)
+        self._size = 0
+        self._cond = asyncio.Condition()
+        self._session = None
+        self._closed = False
+        self._warming = set()
+        self._reaper = None
+
+    def _start_reaper(self):
+        # 需要运行中的事件循环，首次使用时才创建
+        if self._reaper is None and not self._closed:
+            self._reaper = asyncio.ensure_future(self._reap_loop())
+
+    def prewarm(self) -> bool:
+        if self._closed or self._idle or self._size >= self.max_size:
+            return False
+        self._start_reaper()
+        self._size += 1
+        task = asyncio.ensure_future(self._prewarm())
+        self._warming.add(task)  # 持有引用，避免任务被回收
+        task.add_done_callback(self._warming.discard)
+        return True
+
+    async def _prewarm(self):
+        try:
+            ws = await self._connect()
+        except Exception:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            return
+        await self.release(ws)
+
+    async def acquire(self, timeout: float = 30):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._start_reaper()
+        async with self._cond:
+            while True:
+                if self._closed:
+                    raise ConnectionError("连接池已关闭")
+                now = time.time()
+                while self._idle:
+                    ws, last_used = self._idle.pop()
+                    if not ws.closed and now - last_used < self.idle_timeout:
+                        return ws
+                    self._size -= 1
+                    await ws.close()
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError(f"连接池已满 ({self.max_size})，等待超时")
+                try:
+                    await asyncio.wait_for(self._cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        try:
+            return await self._connect()
+        except BaseException:
+            async with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    async def release(self, ws, reusable: bool = True):
+        async with self._cond:
+            if reusable and not ws.closed and not self._closed:
+                self._idle.append((ws, time.time()))
+                self._cond.notify()
+                return
+            self._size -= 1
+            self._cond.notify()
+        await ws.close()
+
+    async def _connect(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        last_error = None
+        for attempt in range(self.max_retries):
+            if attempt:
+                delay = self.backoff_base * (2 ** (attempt - 1))
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            try:
+                started = time.monotonic()
+                ws = await asyncio.wait_for(
+                    self._session.ws_connect(self.url, headers=self.headers, heartbeat=30),
+                    self.connect_timeout,
+                )
+                M_HANDSHAKE.observe(time.monotonic() - started)
+                return ws
+            except Exception as e:
+                last_error = e
+                print(f"[连接池] 握手失败 #{attempt + 1}: {e}", file=sys.stderr)
+        raise ConnectionError(f"上游连接失败: {last_error}")
+
+    async def _reap_loop(self):
+        interval = max(1.0, self.idle_timeout / 2)
+        while not self._closed:
+            await asyncio.sleep(interval)
+            await self.evict_idle()
+
+    async def evict_idle(self):
+        """关闭空闲超时或已断开的连接"""
+        now = time.time()
+        evicted = []
+        async with self._cond:
+            keep = deque()
+            for ws, last_used in self._idle:
+                if not ws.closed and now - last_used < self.idle_timeout:
+                    keep.append((ws, last_used))
+                else:
+                    evicted.append(ws)
+            self._idle = keep
+            self._size -= len(evicted)
+            if evicted:
+                self._cond.notify_all()
+        for ws in evicted:
+            await ws.close()
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        async with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for ws, _ in idle:
+            await ws.close()
+        if self._session is not None:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        return {"size": self._size, "idle": len(self._idle), "max_size": self.max_size}
+
+
+class StreamChannel:
+    """以关闭为结束信号的推送通道
+
+    连接线程 put 正文增量，消费者在条件变量上等待，
+    有数据或连接结束时立即被唤醒，不再定时轮询。
+    """
+
+    def __init__(self):
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def put(self, item: str):
+        with self._cond:
+            self._items.append(item)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def get_batch(self, max_chars: int = 4096, max_wait: float = 0):
+        """阻塞直到有数据，把已到达的增量合并成一段返回；通道关闭且取空后返回 None
+
+        max_wait > 0 时，拿到第一段后最多再等 max_wait 秒凑够 max_chars，
+        用来把零碎的小增量合并成较大的 SSE 帧。
+        """
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if not self._items:
+                return None
+            if max_wait > 0 and not self._closed:
+                deadline = time.monotonic() + max_wait
+                while not self._closed and sum(map(len, self._items)) < max_chars:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            parts = [self._items.popleft()]
+            size = len(parts[0])
+            while self._items and size + len(self._items[0]) <= max_chars:
+                item = self._items.popleft()
+                parts.append(item)
+                size += len(item)
+        return "".join(parts)
+
+
+class _UpstreamRequest:
+    """单次上游请求的帧处理，把连接线程的回调推送到 StreamChannel"""
+
+    def __init__(self):
+        self.channel = StreamChannel()
+        self.result = {"cid": None, "error": None, "finished": False}
+
+    def parse(self, message):
+        """解析一帧上游消息并更新 result，返回正文增量 (无正文时返回 None)"""
+        result = self.result
+        try:
+            data = json.loads(message)
+            t = data.get("t")
+            if t == "s":
+                result["cid"] = data.get("cid")
+            elif t == "m":
+                return data.get("c", "")
+            elif t == "n":
+                result["finished"] = True
+            elif t in ("e", "err"):
+                result["error"] = data.get("c", "Error")
+        except Exception as e:
+            result["error"] = str(e)
+        return None
+
+    @property
+    def ended(self) -> bool:
+        return self.result["finished"] or self.result["error"] is not None
+
+    def on_message(self, message):
+        content = self.parse(message)
+        if content:
+            self.channel.put(content)
+        if self.ended:
+            self.channel.close()
+
+    def on_error(self, error):
+        if not self.ended:
+            self.result["error"] = str(error)
+        self.channel.close()
+
+    def on_close(self):
+        if not self.ended:
+            self.result["error"] = "上游连接已关闭"
+        self.channel.close()
+
+class Session:
+    """一个客户端的会话：独立的 cid、消息计数和占用标记"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.cid = None
+        self.message_count = 0
+        self.prefix = []  # 上游 cid 已持有的轮次摘要
+        self.account = None  # cid 只在创建它的账号下有效，会话固定在该账号上
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.context_tokens = 0  # 当前对话的上下文规模，用于判断何时轮换
+        self.lock = threading.Lock()  # 只保护 in_flight，不跨上游 I/O 持有
+        self.in_flight = False
+        self.lease = None  # 共享会话存储里的占用租约
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+    @property
+    def busy(self) -> bool:
+        return self.in_flight
+
+    def claim(self) -> bool:
+        """占用会话的 cid；已有请求在用时返回 False，不等待"""
+        with self.lock:
+            if self.in_flight:
+                return False
+            self.in_flight = True
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight = False
+
+    def reset(self):
+        self.cid = None
         self.message_count = 0
+        self.prefix = []
+        self.context_tokens = 0
+
+    def info(self) -> dict:
+        return {
+            "session": self.key,
+            "current_cid": self.cid[:20] + "..." if self.cid else None,
+            "message_count": self.message_count,
+            "account": self.account.name if self.account else None,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "context_tokens": self.context_tokens,
+            "last_used": round(self.last_used, 3),
+        }
+
+
+class SessionTable:
+    """按客户端分片的会话表，LRU + TTL 淘汰，容量有界"""
+
+    def __init__(self, max_sessions: int = 1024, ttl: float = 3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Session:
+        now = time.time()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = Session(key)
+            else:
+                self._sessions.move_to_end(key)
+            session.last_used = now
+            self._evict(now)
+        return session
+
+    def _evict(self, now: float):
+        # 从最久未用的一端扫描，跳过正在处理请求的会话
+        for key in list(self._sessions):
+            over = len(self._sessions) > self.max_sessions
+            session = self._sessions[key]
+            if not over and now - session.last_used < self.ttl:
+                break
+            if not session.busy:
+                del self._sessions[key]
+                print(f"[会话] 淘汰 {key}", file=sys.stderr)
+
+    def reset(self, key: str = None):
+        with self._lock:
+            if key is None:
+                targets = list(self._sessions.values())
+            else:
+                targets = [self._sessions[key]] if key in self._sessions else []
+        for session in targets:
+            session.reset()
+
+    def peek(self, key: str):
+        with self._lock:
+            return self._sessions.get(key)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [s.info() for s in sessions]
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class UsageMeter:
+    """按模型累计请求数和 token 用量，供 /metrics 做容量规划"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def record(self, model: str, input_tokens: int, output_tokens: int):
+        with self._lock:
+            usage = self._models.get(model)
+            if usage is None:
+                usage = self._models[model] = {"requests": 0, "input_tokens": 0, "output_tokens": 0}
+            usage["requests"] += 1
+            usage["input_tokens"] += input_tokens
+            usage["output_tokens"] += output_tokens
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {model: dict(usage) for model, usage in self._models.items()}
+
+
+class Account:
+    """一个上游账号：独立的 cookies、uid、连接池和健康状态"""
+
+    def __init__(self, name: str, cookies: str, uid: str, pool: ConnectionPool):
+        self.name = name
+        self.cookies = cookies
+        self.uid = uid
+        self.pool = pool
+        self.apool = None  # asyncio 模式下由 create_async_app 创建
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # 连续失败次数
+        self.strikes = 0  # 连续进入冷却的次数，冷却时间按此翻倍
+        self.cooldown_until = 0.0
+
+    @property
+    def cooling(self) -> bool:
+        return time.monotonic() < self.cooldown_until
+
+    def stats(self) -> dict:
+        pool = self.apool or self.pool
+        return {
+            "name": self.name,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "cooldown": max(0.0, round(self.cooldown_until - time.monotonic(), 1)),
+            "pool": pool.stats(),
+        }
+
+
+class AccountPool:
+    """多账号负载均衡
+
+    - least_loaded: 选在途请求最少的账号 (并列时轮转)；round_robin: 依次轮转
+    - 上游报限流立即冷却；其他错误连续 max_failures 次后冷却，冷却时间逐次翻倍
+    - 每个账号同时在途不超过 max_in_flight (不超过连接池大小)，满了就排队等，
+      不让请求卡在连接池里超时
+    - 会话优先留在原账号 (cid 属于该账号)：原账号冷却中立即迁移，
+      原账号满载时最多等 sticky_wait 秒，仍轮不到就迁移到有空位的账号
+    """
+
+    _RATE_LIMITED = re.compile(r"rate[ _-]?limit|too many requests|\b429\b|quota|频繁|限流", re.I)
+
+    def __init__(self, accounts: list, strategy: str = "least_loaded",
+                 cooldown: float = 60, max_failures: int = 3,
+                 max_in_flight: int = 8, sticky_wait: float = 5):
+        if not accounts:
+            raise ValueError("至少需要一个账号")
+        self.accounts = accounts
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.max_failures = max_failures
+        self.max_in_flight = max_in_flight
+        self.sticky_wait = sticky_wait
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._waiters = []  # 等空位的唤醒函数，线程版与 asyncio 版共用
+
+    def __iter__(self):
+        return iter(self.accounts)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def _has_room(self, account: Account) -> bool:
+        return account.in_flight < self.max_in_flight
+
+    def _choose(self):
+        """挑一个有空位的账号，都满了返回 None；调用方持有锁"""
+        n = len(self.accounts)
+        ordered = [self.accounts[(self._cursor + i) % n] for i in range(n)]
+        self._cursor = (self._cursor + 1) % n
+        healthy = [a for a in ordered if not a.cooling]
+        if not healthy:
+            # 全部冷却时不直接失败，选最快恢复的那个
+            ready = [a for a in ordered if self._has_room(a)]
+            return min(ready, key=lambda a: a.cooldown_until) if ready else None
+        healthy = [a for a in healthy if self._has_room(a)]
+        if not healthy:
+            return None
+        if self.strategy == "round_robin":
+            return healthy[0]
+        return min(healthy, key=lambda a: a.in_flight)
+
+    def _try_acquire(self, preferred: Account, migrate: bool, wake):
+        """有空位则占用并返回账号，否则登记 wake 等释放；调用方持有锁"""
+        if preferred is not None and not preferred.cooling and (self._has_room(preferred) or not migrate):
+            account = preferred if self._has_room(preferred) else None
+        else:
+            account = self._choose()
+        if account is None:
+            self._waiters.append(wake)
+            return None
+        account.in_flight += 1
+        account.requests += 1
+        return account
+
+    def _forget(self, wake):
+        with self._lock:
+            if wake in self._waiters:
+                self._waiters.remove(wake)
+
+    def _wait_until(self, started: float, deadline: float, preferred: Account) -> float:
+        """本轮最多等到何时：还在 sticky_wait 内时等到可以迁移为止"""
+        if preferred is not None and time.monotonic() < started + self.sticky_wait:
+            return min(deadline, started + self.sticky_wait)
+        return deadline
+
+    def acquire(self, preferred: Account = None, timeout: float = 60) -> Account:
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            event = threading.Event()
+            with self._lock:
+                account = self._try_acquire(preferred, time.monotonic() >= started + self.sticky_wait, event.set)
+            if account is not None:
+                return account
+            now = time.monotonic()
+            if now >= deadline:
+                self._forget(event.set)
+                raise QueueTimeout(f"等待账号空位超过 {timeout:g}s")
+            event.wait(self._wait_until(started, deadline, preferred) - now)
+            self._forget(event.set)
+
+    async def aacquire(self, preferred: Account = None, timeout: float = 60) -> Account:
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = started + timeout
+        while True:
+            future = loop.create_future()
+            
+            def wake(future=future):
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+            
+            with self._lock:
+                account = self._try_acquire(preferred, time.monotonic() >= started + self.sticky_wait, wake)
+            if account is not None:
+                return account
+            now = time.monotonic()
+            if now >= deadline:
+                self._forget(wake)
+                raise QueueTimeout(f"等待账号空位超过 {timeout:g}s")
+            try:
+                await asyncio.wait_for(future, self._wait_until(started, deadline, preferred) - now)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._forget(wake)
+
+    def release(self, account: Account, error_type: str = None, message: str = ""):
+        """请求结束时调用，error_type 为 None 表示成功"""
+        with self._lock:
+            account.in_flight -= 1
+            self._record(account, error_type, message)
+            woken, self._waiters = self._waiters, []
+        # 空出的位置可能被任何一个等待者用上，全部唤醒后各自重试
+        for wake in woken:
+            wake()
+
+    def _record(self, account: Account, error_type: str, message: str):
+        if error_type is None:
+            account.failures = 0
+            account.strikes = 0
+            M_ACCOUNT_REQUESTS.labels(account.name, "ok").inc()
+            return
+        if error_type == "pool_timeout":
+            return  # 本地连接池排满，与账号健康无关
+        account.errors += 1
+        account.failures += 1
+        rate_limited = error_type == "upstream" and self._RATE_LIMITED.search(message or "")
+        M_ACCOUNT_REQUESTS.labels(account.name, "rate_limited" if rate_limited else "error").inc()
+        if rate_limited or account.failures >= self.max_failures:
+            account.strikes += 1
+            seconds = self.cooldown * min(2 ** (account.strikes - 1), 16)
+            account.cooldown_until = time.monotonic() + seconds
+            account.failures = 0
+            print(f"[账号] {account.name} 冷却 {seconds:.0f}s ({message or error_type})", file=sys.stderr)
+
+    def get(self, name: str):
+        for account in self.accounts:
+            if account.name == name:
+                return account
+        return None
+
+    def pool_stats(self) -> dict:
+        total = {"size": 0, "idle": 0, "max_size": 0}
+        for account in self.accounts:
+            for name, value in (account.apool or account.pool).stats().items():
+                total[name] += value
+        return total
+
+    def stats(self) -> list:
+        return [a.stats() for a in self.accounts]
+
+
+def load_accounts(path: str) -> list:
+    """读取账号文件
+
+    JSON: [{"name": "a", "cookies": "...", "uid": "可选"}, ...]
+    或纯文本: 每行一个 cookies 字符串，# 开头为注释
+    """
+    with open(os.path.expanduser(path)) as f:
+        text = f.read()
+    try:
+        entries = json.loads(text)
+    except ValueError:
+        entries = [
+            {"cookies": line.strip()} for line in text.splitlines()
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
+    accounts = []
+    for i, entry in enumerate(entries):
+        if isinstance(entry, str):
+            entry = {"cookies": entry}
+        if not entry.get("cookies"):
+            raise ValueError(f"{path}: 第 {i + 1} 个账号缺少 cookies")
+        entry.setdefault("name", f"account-{i + 1}")
+        accounts.append(entry)
+    return accounts
+
+
+def session_key(headers) -> str:
+    """按 x-session-id / x-api-key / Authorization 区分客户端，原值只保留摘要"""
+    raw = headers.get("x-session-id") or headers.get("x-api-key") or headers.get("authorization")
+    if not raw:
+        return "default"
+    return hashlib.sha256(raw.encode()).hexdigest()[:16]
+
+
+class TruncationDetector:
+    """流式的括号/代码块状态机，随增量更新，每次判断只花 O(delta)
+
+    - 只统计代码块和行内代码之外的 {} []，代码块是否闭合单独判断
+    - 处在 {} / [] 内部时跟踪 JSON 字符串，字符串里的括号不计数
+    - ``` 被拆在两个增量之间也能正确识别
+    """
+
+    _SPECIAL = re.compile(r'`+|[{}\[\]"\\\n]')
+
+    def __init__(self):
+        self.braces = 0
+        self.brackets = 0
+        self.in_fence = False
+        self.in_inline = False
+        self.in_string = False
+        self._ticks = 0  # 增量末尾尚未结束的连续反引号
+        self._offset = 0
+        self._escaped_at = -1  # 被反斜杠转义的字符位置
+
+    @property
+    def fence_open(self) -> bool:
+        return self.in_fence != (self._ticks >= 3)
+
+    def _flush_ticks(self):
+        if self._ticks >= 3:
+            self.in_fence = not self.in_fence
+            self.in_inline = False
+            self.in_string = False
+        elif self._ticks and not self.in_fence:
+            self.in_inline = not self.in_inline
+        self._ticks = 0
+
+    def feed(self, text: str):
+        if not text:
+            return
+        if self._ticks and text[0] != "`":
+            self._flush_ticks()
+        end = len(text)
+        for m in self._SPECIAL.finditer(text):
+            ch = m.group()
+            start = m.start()
+            if ch[0] == "`":
+                if start or not self._ticks:
+                    self._flush_ticks()
+                self._ticks += len(ch)
+                if m.end() < end:
+                    self._flush_ticks()
+                continue
+            if ch == "\n":
+                self.in_inline = False
+                self.in_string = False  # JSON 字符串不跨行，防止正文里的引号误伤
+                continue
+            if self.in_fence or self.in_inline:
+                continue
+            if self.in_string:
+                if self._offset + start == self._escaped_at:
+                    continue
+                if ch == "\\":
+                    self._escaped_at = self._offset + start + 1
+                elif ch == '"':
+                    self.in_string = False
+                continue
+            if ch == '"':
+                self.in_string = self.braces > 0 or self.brackets > 0
+            elif ch == "{":
+                self.braces += 1
+            elif ch == "}":
+                self.braces = max(0, self.braces - 1)
+            elif ch == "[":
+                self.brackets += 1
+            elif ch == "]":
+                self.brackets = max(0, self.brackets - 1)
+        self._offset += end
+
+
+def _turn_hash(turn: str) -> str:
+    """单轮对话的摘要，忽略空白差异 (客户端回传时常会去掉首尾空白)"""
+    return hashlib.sha1(" ".join(turn.split()).encode()).hexdigest()
+
+
+class Overloaded(Exception):
+    """准入队列已满，直接拒绝"""
+
+    error_type = "overloaded"
+
+
+class QueueTimeout(Overloaded):
+    """排队超过 queue_timeout 仍未轮到"""
+
+    error_type = "queue_timeout"
+
+
+class _Waiter:
+    __slots__ = ("client", "priority", "enqueued", "wake", "granted", "cancelled")
+
+    def __init__(self, client: str, priority: int, wake):
+        self.client = client
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    """chat_stream 之前的准入控制
+
+    - 同时打到上游的请求不超过 max_in_flight，其余排队
+    - 按优先级出队 (数字越小越优先)，同一优先级内按客户端公平分配:
+      先放行当前在途请求最少的客户端，同样少时轮转
+    - 队列超过 max_queue 直接拒绝，排队超过 queue_timeout 放弃
+    线程版和 asyncio 版等待者共用同一套调度，只是唤醒方式不同。
+    """
+
+    def __init__(self, max_in_flight: int = 8, max_queue: int = 256, queue_timeout: float = 60):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._lock = threading.Lock()
+        self._levels = {}  # priority -> OrderedDict(client -> deque[_Waiter])
+        self._client_in_flight = {}
+
+    def _enqueue(self, client: str, priority: int, wake) -> _Waiter:
+        waiter = _Waiter(client, priority, wake)
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self.queued:
+                self._grant(waiter)
+                return waiter
+            if self.queued >= self.max_queue:
+                raise Overloaded(f"排队请求已达上限 {self.max_queue}")
+            level = self._levels.setdefault(priority, OrderedDict())
+            level.setdefault(client, deque()).append(waiter)
+            self.queued += 1
+        return waiter
+
+    def _grant(self, waiter: _Waiter):
+        waiter.granted = True
+        self.in_flight += 1
+        self._client_in_flight[waiter.client] = self._client_in_flight.get(waiter.client, 0) + 1
+        M_QUEUE_WAIT.observe(time.monotonic() - waiter.enqueued)
+
+    def _dispatch(self) -> list:
+        """在锁内挑出可以放行的等待者，返回它们的唤醒函数 (锁外调用)"""
+        woken = []
+        while self.in_flight < self.max_in_flight and self.queued:
+            priority = min(self._levels)
+            level = self._levels[priority]
+            client = min(level, key=lambda c: self._client_in_flight.get(c, 0))
+            waiters = level[client]
+            waiter = waiters.popleft()
+            self.queued -= 1
+            if waiters:
+                level.move_to_end(client)  # 同样在途数时轮到下一个客户端
+            else:
+                del level[client]
+                if not level:
+                    del self._levels[priority]
+            self._grant(waiter)
+            woken.append(waiter.wake)
+        return woken
+
+    def _cancel(self, waiter: _Waiter) -> bool:
+        """放弃排队；已经被放行则返回 False"""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.cancelled = True
+            level = self._levels.get(waiter.priority, {})
+            waiters = level.get(waiter.client)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                self.queued -= 1
+                if not waiters:
+                    del level[waiter.client]
+                    if not level:
+                        del self._levels[waiter.priority]
+            return True
+
+    def acquire(self, client: str, priority: int = 5) -> _Waiter:
+        event = threading.Event()
+        waiter = self._enqueue(client, priority, event.set)
+        if not waiter.granted and not event.wait(self.queue_timeout) and self._cancel(waiter):
+            raise QueueTimeout(f"排队超过 {self.queue_timeout}s")
+        return waiter
+
+    async def aacquire(self, client: str, priority: int = 5) -> _Waiter:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+        
+        waiter = self._enqueue(client, priority, wake)
+        if waiter.granted:
+            return waiter
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._cancel(waiter):
+                raise QueueTimeout(f"排队超过 {self.queue_timeout}s")
+        except asyncio.CancelledError:
+            if not self._cancel(waiter):
+                self.release(waiter)
+            raise
+        return waiter
+
+    def release(self, waiter: _Waiter):
+        with self._lock:
+            if not waiter.granted:
+                return
+            waiter.granted = False  # 重复 release 无副作用
+            self.in_flight -= 1
+            n = self._client_in_flight.get(waiter.client, 1) - 1
+            if n:
+                self._client_in_flight[waiter.client] = n
+            else:
+                self._client_in_flight.pop(waiter.client, None)
+            woken = self._dispatch()
+        for wake in woken:
+            wake()
+
+    def stats(self) -> dict:
+        return {"in_flight": self.in_flight, "queued": self.queued, "max_in_flight": self.max_in_flight}
+
+
+def request_priority(headers) -> int:
+    try:
+        return int(headers.get("x-priority", 5))
+    except ValueError:
+        return 5
+
+
+def _error_type(error: Exception) -> str:
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError)):
+        return "pool_timeout"
+    return "upstream_connect"
+
+
+class _ChatState:
+    """一次 /v1/messages 请求的状态，线程版与 asyncio 版共用"""
+
+    def __init__(self, session: Session, prompt: str, model: str, model_config: dict, msg_id: str):
+        self.session = session
+        self.account = None
+        self.error = None  # (error_type, message)，用于账号健康统计
+        self.cache_key = None
+        self.prompt = prompt
+        self.model = model
+        self.model_config = model_config
+        self.msg_id = msg_id
+        self.full_content = ""
+        self.segment = ""
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.continuation = 0
+        self.current_prompt = prompt
+        self.reuse_cid = False
+        self.turn_hashes = []
+        self.started = time.monotonic()
+        self.last_chunk_at = None
+        self.detector = TruncationDetector()
+        self.prewarmed = False  # 本段已为续写预热过连接
+        self.segment_ended = None  # 上一段结束的时刻，用于统计续写间隔
+        self.parser = None  # 请求带 tools 时解析上游输出里的 <tool_use>
+        self.blocks = []  # 组装好的 content 块 (text / tool_use)
+        self.tool_json = ""  # 当前 tool_use 已收到的参数 JSON
+        self.sse_index = -1  # SSE 当前打开的块序号和类型
+        self.sse_block = None
+
+    def add(self, event):
+        """把一个增量事件并入 blocks"""
+        kind, value = event
+        if kind == "delta":
+            if self.blocks and self.blocks[-1]["type"] == "text":
+                self.blocks[-1]["text"] += value
+            else:
+                self.blocks.append({"type": "text", "text": value})
+        elif kind == "tool_start":
+            self.blocks.append({"type": "tool_use", "id": value["id"], "name": value["name"], "input": {}})
+            self.tool_json = ""
+        elif kind == "tool_delta":
+            self.tool_json += value
+        elif kind == "tool_stop":
+            try:
+                self.blocks[-1]["input"] = json.loads(self.tool_json) if self.tool_json.strip() else {}
+            except ValueError:
+                print(f"[工具] {self.blocks[-1]['name']} 的参数不是合法 JSON", file=sys.stderr)
+            self.tool_json = ""
+        return event
+
+    @property
+    def stop_reason(self) -> str:
+        return "tool_use" if any(b["type"] == "tool_use" for b in self.blocks) else "end_turn"
+
+
+def _content(blocks: list) -> list:
+    """去掉空文本块；一个块都没有时保留一个空文本块"""
+    content = [b for b in blocks if b["type"] != "text" or b["text"]]
+    return content or [{"type": "text", "text": ""}]
+
+
+def _cached_blocks(entry: dict) -> list:
+    content = entry["content"]
+    return [{"type": "text", "text": content}] if isinstance(content, str) else content
+
+
+def _message(msg_id: str, model: str, content: list, stop_reason: str, input_tokens: int, output_tokens: int) -> dict:
+    return {
+        "id": msg_id,
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+    }
+
+
+class _MessageBuilder:
+    """把事件流收集成一个完整的 Message (stream:false)"""
+
+    def __init__(self):
+        self.state = None
+        self.stop = None
+        self.error = None
+
+    def feed(self, state: "_ChatState", event):
+        kind, value = event
+        self.state = state
+        if kind == "stop":
+            self.stop = value
+        elif kind == "error":
+            self.error = value
+
+    def result(self):
+        if self.error is not None or self.stop is None:
+            return 500, {"type": "error", "error": {"type": "api_error", "message": self.error or "上游未返回结果"}}
+        state = self.state
+        return 200, _message(state.msg_id, state.model, _content(state.blocks), self.stop["stop_reason"],
+                             state.input_tokens, self.stop["output_tokens"])
+
+
+class GensparkBridge:
+    def __init__(self, cookies: str = None, pool_size: int = 8, pool_idle_timeout: float = 120,
+                 max_sessions: int = 1024, session_ttl: float = 3600,
+                 coalesce_chars: int = 4096, coalesce_wait: float = 0,
+                 tokenizer: str = "approx", max_tokens_per_conversation: int = 0,
+                 max_in_flight: int = None, max_queue: int = 256, queue_timeout: float = 60,
+                 accounts: list = None, account_strategy: str = "least_loaded", account_cooldown: float = 60,
+                 account_max_in_flight: int = None, account_sticky_wait: float = 5,
+                 ws_url: str = None, cache: ResponseCache = None,
+                 continuation_delay: float = 0, prewarm_chars: int = 2000, store=None):
+        self.ws_url = ws_url or "wss://vear.com/conversation/go"
+        self.headers = [
+            "Origin: https://www.genspark.ai",
+            "User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
+        ]
+        # 每个账号各自的 uid 和连接池；只给 cookies 时就是单账号
+        self.accounts = AccountPool(
+            [
+                Account(
+                    entry.get("name", "default"),
+                    entry["cookies"],
+                    entry.get("uid") or self._generate_uid(),
+                    ConnectionPool(self.ws_url, entry["cookies"], self.headers,
+                                   max_size=pool_size, idle_timeout=pool_idle_timeout),
+                )
+                for entry in (accounts or [{"name": "default", "cookies": cookies}])
+            ],
+            strategy=account_strategy,
+            cooldown=account_cooldown,
+            # 超过连接池大小的在途请求只会卡在池里等连接
+            max_in_flight=min(account_max_in_flight or pool_size, pool_size),
+            sticky_wait=account_sticky_wait,
+        )
+        self.admission = AdmissionController(
+            max_in_flight=max_in_flight or self.accounts.max_in_flight * len(self.accounts),
+            max_queue=max_queue,
+            queue_timeout=queue_timeout,
+        )
+        
+        # 会话管理 - 每个客户端各自复用对话
+        self.sessions = SessionTable(max_sessions=max_sessions, ttl=session_ttl)
+        # 多 worker 时会话状态放在共享存储里，SessionTable 只是本进程的缓存
+        self.store = store or MemorySessionStore()
         self.max_messages_per_conversation = 50  # 每50条消息新建对话
+        self.max_tokens_per_conversation = max_tokens_per_conversation  # 0 表示不按 token 轮换
+        
+        # 相同请求的回复缓存 (None 表示关闭)
+        self.cache = cache
+        
+        # 用量统计
+        self.tokens = TokenCounter.create(tokenizer)
+        self.usage = UsageMeter()
         
         self.genspark_models = {
             "claude-4.5-opus":    {"md": 11, "mds": 9},
@@ -55,6 +1311,12 @@ class GensparkBridge:
         }
         
         self.max_continuations = 10
+        self.continuation_delay = continuation_delay  # 续写前的停顿 (秒)，默认不等
+        self.prewarm_chars = prewarm_chars  # 当前段超过这么长且像被截断时预热下一条连接，0 关闭
+        
+        # 合并零碎增量：单帧最多 coalesce_chars 字符，首段到达后最多再等 coalesce_wait 秒
+        self.coalesce_chars = coalesce_chars
+        self.coalesce_wait = coalesce_wait
         self.force_opus = True  # 强制使用 Opus
     
     def _generate_uid(self):
@@ -73,6 +1335,10 @@ class GensparkBridge:
     def _get_model_config(self, model: str) -> dict:
         if self.force_opus:
             print(f"[模型] 强制使用 claude-4.5-opus", file=sys.stderr)
+        return self._resolve_model(model)
+    
+    def _resolve_model(self, model: str) -> dict:
+        if self.force_opus:
             return self.genspark_models["claude-4.5-opus"]
         
         genspark_name = self.anthropic_to_genspark.get(model)
@@ -80,226 +1346,673 @@ class GensparkBridge:
             return self.genspark_models[genspark_name]
         return self.genspark_models["claude-4.5-opus"]
     
-    def _should_new_conversation(self) -> bool:
-        """判断是否需要新建对话"""
-        if self.current_cid is None:
+    def _should_new_conversation(self, session: Session) -> bool:
+        """判断是否需要新建对话；只判断不改状态，轮换由 _start_chat 每轮做一次"""
+        if session.cid is None:
             return True
-        if self.message_count >= self.max_messages_per_conversation:
-            print(f"[会话] 消息数达到 {self.message_count}，新建对话", file=sys.stderr)
-            self.message_count = 0
+        if session.message_count >= self.max_messages_per_conversation:
             return True
-        return False
+        return bool(self.max_tokens_per_conversation and session.context_tokens >= self.max_tokens_per_conversation)
     
-    def _is_truncated(self, text: str, full_content: str) -> bool:
-        if not text or len(text) < 50:
+    def _is_truncated(self, segment: str, detector: "TruncationDetector") -> bool:
+        if not segment or len(segment) < 50:
             return False
-        
-        full = full_content.rstrip()
-        
-        open_braces = full.count('{') - full.count('}')
-        open_brackets = full.count('[') - full.count(']')
-        if open_braces > 0 or open_brackets > 0:
-            return True
-        
-        if len(re.findall(r'```', full)) % 2 != 0:
-            return True
-        
-        return False
+        return detector.braces > 0 or detector.brackets > 0 or detector.fence_open
     
-    def _get_continue_prompt(self, full_content: str) -> str:
-        if full_content.count('{') > full_content.count('}'):
+    def _get_continue_prompt(self, detector: "TruncationDetector") -> str:
+        if detector.braces > 0:
             return "继续，不要重复"
-        if len(re.findall(r'```', full_content)) % 2 != 0:
+        if detector.fence_open:
             return "继续完成代码，不要重复"
         return "继续"
     
-    def _send_message(self, prompt: str, model_config: dict, use_existing_cid: bool = True):
-        response_queue = queue.Queue()
-        done_event = threading.Event()
-        result = {"content": "", "cid": None, "error": None}
-        
+    def _build_payload(self, session: Session, prompt: str, model_config: dict, use_existing_cid: bool) -> dict:
         # 决定是否复用 cid
-        cid_to_use = self.current_cid if (use_existing_cid and not self._should_new_conversation()) else None
+        cid_to_use = session.cid if use_existing_cid else None
         
-        def on_message(ws, message):
+        payload = {
+            "uid": session.account.uid,
+            "mid": self._generate_mid(),
+            "q": prompt,
+            "m": model_config["md"],
+            "ms": model_config["mds"],
+            "t": "m"
+        }
+        if cid_to_use:
+            payload["cid"] = cid_to_use
+            print(f"[会话] 复用 cid: {cid_to_use[:20]}...", file=sys.stderr)
+        else:
+            print(f"[会话] 新建对话", file=sys.stderr)
+        return payload
+    
+    def _send_message(self, session: Session, prompt: str, model_config: dict, use_existing_cid: bool = True):
+        payload = self._build_payload(session, prompt, model_config, use_existing_cid)
+        pool = session.account.pool
+        for attempt in range(2):
+            req = _UpstreamRequest()
+            conn = pool.acquire()
             try:
-                data = json.loads(message)
-                t = data.get("t")
-                if t == "s":
-                    result["cid"] = data.get("cid")
-                elif t == "m":
-                    content = data.get("c", "")
-                    result["content"] += content
-                    response_queue.put(("content", content))
-                elif t == "n":
-                    done_event.set()
-                elif t in ("e", "err"):
-                    result["error"] = data.get("c", "Error")
-                    done_event.set()
-            except Exception as e:
-                result["error"] = str(e)
-                done_event.set()
+                conn.send(req, payload)
+            except (websocket.WebSocketException, OSError) as e:
+                # 发送失败时还没收到任何帧，丢掉这条连接换新连接重发一次即可
+                pool.release(conn, reusable=False)
+                if attempt:
+                    raise ConnectionError(f"上游发送失败: {e}") from e
+                print(f"[连接] 发送失败，换新连接重试: {e}", file=sys.stderr)
+                continue
+            except Exception:
+                pool.release(conn, reusable=False)
+                raise
+            return req.channel, req.result, conn
+    
+    def _convert_turn(self, msg: dict) -> str:
+        role = msg.get("role", "user")
+        content = msg.get("content", "")
         
-        def on_error(ws, error):
-            result["error"] = str(error)
-            done_event.set()
+        if isinstance(content, list):
+            text_parts = []
+            for block in content:
+                if isinstance(block, dict):
+                    if block.get("type") == "text":
+                        text_parts.append(block.get("text", ""))
+                    elif block.get("type") == "tool_result":
+                        text_parts.append(tool_calls.encode_tool_result(block))
+                    elif block.get("type") == "tool_use":
+                        text_parts.append(tool_calls.encode_tool_use(block))
+                elif isinstance(block, str):
+                    text_parts.append(block)
+            content = "\n".join(text_parts)
         
-        def on_open(ws):
-            payload = {
-                "uid": self.uid,
-                "mid": self._generate_mid(),
-                "q": prompt,
-                "m": model_config["md"],
-                "ms": model_config["mds"],
-                "t": "m"
-            }
-            if cid_to_use:
-                payload["cid"] = cid_to_use
-                print(f"[会话] 复用 cid: {cid_to_use[:20]}...", file=sys.stderr)
-            else:
-                print(f"[会话] 新建对话", file=sys.stderr)
-            
-            ws.send(json.dumps(payload))
+        prefix = "Human:" if role == "user" else "Assistant:"
+        return f"{prefix} {content}"
+    
+    def _convert_turns(self, messages: list, system: str = None, tools: list = None, tool_choice: dict = None) -> list:
+        turns = []
+        if system:
+            turns.append(f"System: {system}")
+        if tools:
+            turns.append(f"System: {tool_calls.encode_tools(tools, tool_choice)}")
+        for msg in messages:
+            turns.append(self._convert_turn(msg))
+        return turns
+    
+    def _convert_messages(self, messages: list, system: str = None) -> str:
+        return "\n\n".join(self._convert_turns(messages, system))
+    
+    def new_conversation(self, key: str = None):
+        """强制新建对话 (不指定 key 时重置所有会话)"""
+        self.sessions.reset(key)
+        self.store.reset(key)
+        print(f"[会话] 已重置 {key or '全部'}", file=sys.stderr)
+    
+    def _start_chat(self, session: Session, account: Account, messages: list, model: str, system: str = None,
+                    tools: list = None, tool_choice: dict = None) -> _ChatState:
+        if account is not session.account:
+            if session.account is not None:
+                # 原账号冷却中，换账号后旧 cid 不可用
+                print(f"[账号] {session.key} 从 {session.account.name} 迁移到 {account.name}", file=sys.stderr)
+                session.reset()
+            session.account = account
+        if session.cid is not None and self._should_new_conversation(session):
+            print(f"[会话] 消息数 {session.message_count}，上下文 {session.context_tokens} tokens，新建对话", file=sys.stderr)
+            session.reset()
         
-        def on_close(ws, code, msg):
-            done_event.set()
+        turns = self._convert_turns(messages, system, tools, tool_choice)
+        hashes = [_turn_hash(t) for t in turns]
         
-        ws = websocket.WebSocketApp(
-            self.ws_url,
-            cookie=self.cookies,
-            header=[
-                "Origin: https://www.genspark.ai",
-                "User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
-            ],
-            on_message=on_message,
-            on_error=on_error,
-            on_open=on_open,
-            on_close=on_close,
+        # 前缀命中：上游 cid 里已经有这些轮次，只发送新增部分
+        sent = session.prefix
+        reuse_cid = (
+            bool(sent) and len(hashes) > len(sent) and hashes[:len(sent)] == sent
         )
+        if reuse_cid:
+            prompt = "\n\n".join(turns[len(sent):])
+            print(f"[前缀] 命中 {len(sent)} 轮，只发送新增 {len(turns) - len(sent)} 轮", file=sys.stderr)
+        else:
+            prompt = "\n\n".join(turns)
+        
+        # 请求成功结束前上游历史处于未知状态，先作废前缀
+        session.prefix = []
+        state = _ChatState(session, prompt, model, self._get_model_config(model), self._generate_msg_id())
+        state.account = account
+        if tools:
+            state.parser = tool_calls.ToolCallParser()
+        state.turn_hashes = hashes
+        state.reuse_cid = reuse_cid
+        state.input_tokens = self.tokens.count_turns(turns)
+        return state
+    
+    def _on_delta(self, state: _ChatState, content: str):
+        state.segment += content
+        state.detector.feed(content)
+        now = time.monotonic()
+        if state.last_chunk_at is None:
+            M_TTFT.observe(now - state.started)
+        else:
+            M_GAP.observe(now - state.last_chunk_at)
+        state.last_chunk_at = now
+        if state.segment_ended is not None:
+            M_CONT_GAP.observe(now - state.segment_ended)
+            state.segment_ended = None
+        if (self.prewarm_chars and not state.prewarmed and len(state.segment) >= self.prewarm_chars
+                and self._is_truncated(state.segment, state.detector)):
+            # 很可能要续写：当前连接若不能复用，下一段也不用现场握手
+            state.prewarmed = True
+            (state.account.apool or state.account.pool).prewarm()
+        if state.parser is None:
+            return [state.add(("delta", content))]
+        return self._tool_events(state, state.parser.feed(content))
+    
+    def _tool_events(self, state: _ChatState, parsed: list) -> list:
+        return [state.add(("delta", v) if kind == "text" else (kind, v)) for kind, v in parsed]
+    
+    def _flush(self, state: _ChatState) -> list:
+        """全部段落结束后吐出解析器扣住的尾巴"""
+        return self._tool_events(state, state.parser.flush()) if state.parser else []
+    
+    def _next_prompt(self, state: _ChatState, result: dict):
+        """一段回复结束：保存 cid，判断是否需要续写，返回续写 prompt 或 None"""
+        segment, state.segment = state.segment, ""
+        state.full_content += segment
         
-        ws_thread = threading.Thread(target=ws.run_forever)
-        ws_thread.daemon = True
-        ws_thread.start()
+        # 保存 cid 用于续写
+        if result["cid"]:
+            state.session.cid = result["cid"]
         
-        return response_queue, done_event, result, ws
+        if state.continuation < self.max_continuations and self._is_truncated(segment, state.detector):
+            state.continuation += 1
+            state.current_prompt = self._get_continue_prompt(state.detector)
+            state.reuse_cid = True
+            state.prewarmed = False
+            state.segment_ended = time.monotonic()
+            print(f"[续写] #{state.continuation}", file=sys.stderr)
+            return state.current_prompt
+        return None
     
-    def _convert_messages(self, messages: list, system: str = None) -> str:
-        parts = []
-        if system:
-            parts.append(f"System: {system}")
+    def _finish_chat(self, state: _ChatState):
+        state.output_tokens = self.tokens.count(state.full_content)
         
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
+        # 完成后增加消息计数
+        session = state.session
+        session.message_count += 1
+        # 按客户端回传时的同一套编码算摘要，下一轮带着 tool_use 块回来也能命中前缀
+        blocks = _content(state.blocks)
+        session.prefix = state.turn_hashes + [
+            _turn_hash(self._convert_turn({"role": "assistant", "content": blocks}))
+        ]
+        session.input_tokens += state.input_tokens
+        session.output_tokens += state.output_tokens
+        session.context_tokens = state.input_tokens + state.output_tokens
+        self.usage.record(state.model, state.input_tokens, state.output_tokens)
+        M_TOKENS.labels(state.model, "input").inc(state.input_tokens)
+        M_TOKENS.labels(state.model, "output").inc(state.output_tokens)
+        M_CONTINUATIONS.observe(state.continuation)
+        if state.cache_key and self.cache is not None:
+            self.cache.put(state.cache_key, {
+                "content": blocks,
+                "stop_reason": state.stop_reason,
+                "input_tokens": state.input_tokens,
+                "output_tokens": state.output_tokens,
+            })
+        print(f"[会话] {session.key} 消息数: {session.message_count}, cid: {session.cid[:20] if session.cid else 'None'}...", file=sys.stderr)
+        return ("stop", {"stop_reason": state.stop_reason, "output_tokens": state.output_tokens})
+    
+    def _fail_chat(self, state: _ChatState, error_type: str, message: str):
+        M_ERRORS.labels(error_type).inc()
+        state.error = (error_type, message)
+        print(f"[错误] {error_type}: {message}", file=sys.stderr)
+        return ("error", message)
+    
+    def _close_block(self, state: _ChatState) -> bytes:
+        if state.sse_block is None:
+            return b""
+        state.sse_block = None
+        return sse.content_block_stop(state.sse_index)
+    
+    def _sse(self, state: _ChatState, event) -> bytes:
+        kind, value = event
+        if kind == "delta":
+            frame = b""
+            if state.sse_block != "text":
+                # 工具调用之后又出现文本，另起一个 text 块
+                frame = self._close_block(state)
+                state.sse_index += 1
+                state.sse_block = "text"
+                frame += sse.content_block_start_text(state.sse_index)
+            return frame + sse.text_delta(value, state.sse_index)
+        if kind == "tool_delta":
+            return sse.input_json_delta(value, state.sse_index)
+        if kind == "tool_start":
+            frame = self._close_block(state)
+            state.sse_index += 1
+            state.sse_block = "tool_use"
+            return frame + sse.content_block_start_tool_use(state.sse_index, value["id"], value["name"])
+        if kind == "tool_stop":
+            return self._close_block(state)
+        if kind == "start":
+            state.sse_index, state.sse_block = 0, "text"
+            return sse.message_start(state.msg_id, state.model, state.input_tokens) + sse.content_block_start_text(0)
+        if kind == "error":
+            return sse.error(value)
+        return (
+            self._close_block(state)
+            + sse.message_delta(value["stop_reason"], value["output_tokens"])
+            + sse.message_stop()
+        )
+    
+    def _events(self, state: _ChatState):
+        """线程版事件流: start → delta* → stop | error"""
+        yield ("start", None)
+        while True:
+            try:
+                channel, result, ws = self._send_message(
+                    state.session,
+                    state.current_prompt, 
+                    state.model_config, 
+                    use_existing_cid=state.reuse_cid  # 前缀命中或续写时复用 cid
+                )
+            except (TimeoutError, ConnectionError) as e:
+                yield self._fail_chat(state, _error_type(e), str(e))
+                return
+            try:
+                while True:
+                    content = channel.get_batch(self.coalesce_chars, self.coalesce_wait)
+                    if content is None:
+                        break
+                    yield from self._on_delta(state, content)
+            finally:
+                # 只有正常收到结束帧的连接才能放回池里，否则残留帧会串到下一个请求
+                state.account.pool.release(ws, reusable=result["finished"] and not result["error"])
             
-            if isinstance(content, list):
-                text_parts = []
-                for block in content:
-                    if isinstance(block, dict):
-                        if block.get("type") == "text":
-                            text_parts.append(block.get("text", ""))
-                        elif block.get("type") == "tool_result":
-                            tc = block.get("content", "")
-                            if isinstance(tc, list):
-                                tc = "\n".join(b.get("text", "") if isinstance(b, dict) else str(b) for b in tc)
-                            text_parts.append(f"[Tool Result]: {tc}")
-                        elif block.get("type") == "tool_use":
-                            text_parts.append(f"[Tool: {block.get('name', '')}]")
-                    elif isinstance(block, str):
-                        text_parts.append(block)
-                content = "\n".join(text_parts)
+            if result["error"]:
+                yield self._fail_chat(state, "upstream", result["error"])
+                return
             
-            prefix = "Human:" if role == "user" else "Assistant:"
-            parts.append(f"{prefix} {content}")
+            if self._next_prompt(state, result) is None:
+                break
+            if self.continuation_delay:
+                time.sleep(self.continuation_delay)
         
-        return "\n\n".join(parts)
+        yield from self._flush(state)
+        yield self._finish_chat(state)
     
-    def new_conversation(self):
-        """强制新建对话"""
-        self.current_cid = None
-        self.message_count = 0
-        print(f"[会话] 已重置", file=sys.stderr)
+    def cache_lookup(self, messages: list, model: str, system: str = None, tools: list = None, tool_choice: dict = None):
+        """返回 (缓存键, 缓存的回复)；缓存关闭时为 (None, None)"""
+        if self.cache is None:
+            return None, None
+        config = self._resolve_model(model)
+        key = cache_key(
+            [f"{config['md']}:{config['mds']}"]
+            + [_turn_hash(t) for t in self._convert_turns(messages, system, tools, tool_choice)]
+        )
+        entry = self.cache.get(key)
+        M_CACHE.labels("hit" if entry else "miss").inc()
+        return key, entry
     
-    def chat_stream(self, messages: list, model: str, system: str = None):
-        prompt = self._convert_messages(messages, system)
-        model_config = self._get_model_config(model)
-        msg_id = self._generate_msg_id()
-        
-        yield f"event: message_start\ndata: {json.dumps({'type': 'message_start', 'message': {'id': msg_id, 'type': 'message', 'role': 'assistant', 'content': [], 'model': model, 'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': 0, 'output_tokens': 0}}})}\n\n"
-        yield f"event: content_block_start\ndata: {json.dumps({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})}\n\n"
-        
-        full_content = ""
-        output_tokens = 0
-        continuation = 0
-        current_prompt = prompt
-        is_first_message = True
-        
-        while continuation <= self.max_continuations:
-            response_queue, done_event, result, ws = self._send_message(
-                current_prompt, 
-                model_config, 
-                use_existing_cid=not is_first_message  # 续写时复用 cid
-            )
-            segment = ""
-            
-            while not done_event.is_set() or not response_queue.empty():
+    def replay_stream(self, entry: dict, model: str):
+        """把缓存的回复按同样的 SSE 事件序列一次性回放"""
+        M_REQUESTS.inc()
+        state = _ChatState(None, "", model, None, self._generate_msg_id())
+        state.input_tokens = entry["input_tokens"]
+        yield self._sse(state, ("start", None))
+        for block in _cached_blocks(entry):
+            if block["type"] == "tool_use":
+                yield self._sse(state, ("tool_start", block))
+                yield self._sse(state, ("tool_delta", json.dumps(block["input"], ensure_ascii=False)))
+                yield self._sse(state, ("tool_stop", None))
+                continue
+            text = block["text"]
+            step = self.coalesce_chars or len(text) or 1
+            for i in range(0, len(text), step):
+                yield self._sse(state, ("delta", text[i:i + step]))
+        yield self._sse(state, ("stop", {"stop_reason": entry["stop_reason"], "output_tokens": entry["output_tokens"]}))
+    
+    def _claim_session(self, session_key: str):
+        """占用会话；同一会话已有请求在跑时不排队，改用不复用也不写回的临时对话"""
+        session = self.sessions.get(session_key)
+        if session.claim():
+            if self.store.claim(session):
+                return session, self.store
+            session.release()
+        return self._temp_session(session)
+    
+    async def _aclaim_session(self, session_key: str):
+        session = self.sessions.get(session_key)
+        if session.claim():
+            try:
+                claimed = await self._run_store(self.store, self.store.claim, session)
+            except BaseException:
+                session.release()
+                raise
+            if claimed:
+                return session, self.store
+            session.release()
+        return self._temp_session(session)
+    
+    def _temp_session(self, session: Session):
+        print(f"[会话] {session.key} 有请求正在处理，本次使用临时对话", file=sys.stderr)
+        temp = Session(session.key)
+        temp.claim()
+        return temp, MemorySessionStore()
+    
+    async def _run_store(self, store, fn, *args):
+        """共享存储的读写是短事务，放到线程池里做，不卡事件循环"""
+        if isinstance(store, MemorySessionStore):
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+    
+    def _chat(self, messages: list, model: str, system: str = None, session_key: str = "default",
+              cache_key: str = None, tools: list = None, tool_choice: dict = None):
+        """一次请求的完整生命周期 (计数、会话锁、账号)，产出 (state, event)"""
+        started = time.monotonic()
+        M_REQUESTS.inc()
+        M_ACTIVE.inc()
+        try:
+            session, store = self._claim_session(session_key)
+            try:
                 try:
-                    msg_type, content = response_queue.get(timeout=0.05)
-                    if msg_type == "content" and content:
-                        segment += content
-                        output_tokens += max(1, len(content) // 4)
-                        yield f"event: content_block_delta\ndata: {json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': content}})}\n\n"
-                except queue.Empty:
-                    continue
-            
-            ws.close()
+                    account = self.accounts.acquire(session.account, self.admission.queue_timeout)
+                except QueueTimeout as e:
+                    M_ERRORS.labels(e.error_type).inc()
+                    yield None, ("error", str(e))
+                    return
+                state = self._start_chat(session, account, messages, model, system, tools, tool_choice)
+                state.started = started
+                state.cache_key = cache_key
+                try:
+                    for event in self._events(state):
+                        yield state, event
+                finally:
+                    self.accounts.release(state.account, *(state.error or ()))
+            finally:
+                try:
+                    store.save(session)
+                finally:
+                    session.release()
+        except GeneratorExit:
+            M_ERRORS.labels("client_disconnect").inc()
+            raise
+        finally:
+            M_ACTIVE.dec()
+            M_DURATION.observe(time.monotonic() - started)
+    
+    def chat_stream(self, messages: list, model: str, system: str = None, session_key: str = "default",
+                    cache_key: str = None, tools: list = None, tool_choice: dict = None):
+        chat = self._chat(messages, model, system, session_key, cache_key, tools, tool_choice)
+        try:
+            for state, event in chat:
+                yield self._sse(state, event)
+        finally:
+            chat.close()
+    
+    def chat_message(self, messages: list, model: str, system: str = None, session_key: str = "default",
+                     cache_key: str = None, tools: list = None, tool_choice: dict = None):
+        """stream:false — 直接由事件拼出 Message，不经过 SSE 编码；返回 (HTTP 状态码, body)"""
+        builder = _MessageBuilder()
+        for state, event in self._chat(messages, model, system, session_key, cache_key, tools, tool_choice):
+            builder.feed(state, event)
+        return builder.result()
+    
+    def cached_message(self, entry: dict, model: str) -> dict:
+        M_REQUESTS.inc()
+        return _message(self._generate_msg_id(), model, _cached_blocks(entry), entry["stop_reason"],
+                        entry["input_tokens"], entry["output_tokens"])
+    
+    async def _asend(self, apool, payload: dict):
+        """asyncio 版发送：失败时丢掉连接换新连接重发一次，仍失败抛 ConnectionError"""
+        for attempt in range(2):
+            ws = await apool.acquire()
+            try:
+                await ws.send_str(json.dumps(payload))
+            except (aiohttp.ClientError, OSError) as e:
+                await apool.release(ws, reusable=False)
+                if attempt:
+                    raise ConnectionError(f"上游发送失败: {e}") from e
+                print(f"[连接] 发送失败，换新连接重试: {e}", file=sys.stderr)
+                continue
+            return ws
+    
+    async def _aevents(self, state: _ChatState):
+        """asyncio 版事件流，不占用额外线程"""
+        apool = state.account.apool
+        yield ("start", None)
+        while True:
+            payload = self._build_payload(
+                state.session,
+                state.current_prompt,
+                state.model_config,
+                use_existing_cid=state.reuse_cid
+            )
+            req = _UpstreamRequest()
+            try:
+                ws = await self._asend(apool, payload)
+            except (TimeoutError, asyncio.TimeoutError, ConnectionError) as e:
+                yield self._fail_chat(state, _error_type(e), str(e))
+                return
+            try:
+                async for frame in ws:
+                    if frame.type != aiohttp.WSMsgType.TEXT:
+                        req.on_close()
+                        break
+                    content = req.parse(frame.data)
+                    if content:
+                        for event in self._on_delta(state, content):
+                            yield event
+                    if req.ended:
+                        break
+                else:
+                    req.on_close()
+            finally:
+                await apool.release(ws, reusable=req.result["finished"] and not req.result["error"])
             
+            result = req.result
             if result["error"]:
-                yield f"event: error\ndata: {json.dumps({'type': 'error', 'error': {'type': 'api_error', 'message': result['error']}})}\n\n"
+                yield self._fail_chat(state, "upstream", result["error"])
                 return
             
-            full_content += segment
-            
-            # 保存 cid 用于续写
-            if result["cid"]:
-                self.current_cid = result["cid"]
-            
-            if self._is_truncated(segment, full_content):
-                continuation += 1
-                current_prompt = self._get_continue_prompt(full_content)
-                is_first_message = False
-                print(f"[续写] #{continuation}", file=sys.stderr)
-                time.sleep(0.3)
-            else:
+            if self._next_prompt(state, result) is None:
                 break
+            if self.continuation_delay:
+                await asyncio.sleep(self.continuation_delay)
         
-        # 完成后增加消息计数
-        self.message_count += 1
-        print(f"[会话] 消息数: {self.message_count}, cid: {self.current_cid[:20] if self.current_cid else 'None'}...", file=sys.stderr)
-        
-        yield f"event: content_block_stop\ndata: {json.dumps({'type': 'content_block_stop', 'index': 0})}\n\n"
-        yield f"event: message_delta\ndata: {json.dumps({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': {'output_tokens': output_tokens}})}\n\n"
-        yield f"event: message_stop\ndata: {json.dumps({'type': 'message_stop'})}\n\n"
+        for event in self._flush(state):
+            yield event
+        yield self._finish_chat(state)
+    
+    async def _achat(self, messages: list, model: str, system: str = None, session_key: str = "default",
+                     cache_key: str = None, tools: list = None, tool_choice: dict = None):
+        started = time.monotonic()
+        M_REQUESTS.inc()
+        M_ACTIVE.inc()
+        try:
+            session, store = await self._aclaim_session(session_key)
+            try:
+                try:
+                    account = await self.accounts.aacquire(session.account, self.admission.queue_timeout)
+                except QueueTimeout as e:
+                    M_ERRORS.labels(e.error_type).inc()
+                    yield None, ("error", str(e))
+                    return
+                state = self._start_chat(session, account, messages, model, system, tools, tool_choice)
+                state.started = started
+                state.cache_key = cache_key
+                try:
+                    async for event in self._aevents(state):
+                        yield state, event
+                finally:
+                    self.accounts.release(state.account, *(state.error or ()))
+            finally:
+                try:
+                    await self._run_store(store, store.save, session)
+                finally:
+                    session.release()
+        finally:
+            M_ACTIVE.dec()
+            M_DURATION.observe(time.monotonic() - started)
+    
+    async def achat_stream(self, messages: list, model: str, system: str = None, session_key: str = "default",
+                           cache_key: str = None, tools: list = None, tool_choice: dict = None):
+        chat = self._achat(messages, model, system, session_key, cache_key, tools, tool_choice)
+        try:
+            async for state, event in chat:
+                yield self._sse(state, event)
+        finally:
+            await chat.aclose()
+    
+    async def achat_message(self, messages: list, model: str, system: str = None, session_key: str = "default",
+                            cache_key: str = None, tools: list = None, tool_choice: dict = None):
+        builder = _MessageBuilder()
+        async for state, event in self._achat(messages, model, system, session_key, cache_key, tools, tool_choice):
+            builder.feed(state, event)
+        return builder.result()
 
 
 bridge = None
 
+
+class Lifecycle:
+    """进程生命周期：收到 SIGTERM 后不再接新请求，等在途的流在期限内结束，
+    再关闭上游连接、输出最终指标，便于在负载均衡后面滚动重启
+    """
+
+    def __init__(self, drain_timeout: float = 30, metrics_dump: str = None):
+        self.drain_timeout = drain_timeout
+        self.metrics_dump = metrics_dump
+        self.draining = threading.Event()
+
+    @staticmethod
+    def in_flight() -> int:
+        if not bridge:
+            return 0
+        return bridge.admission.in_flight + bridge.admission.queued
+
+    def begin_drain(self):
+        if self.draining.is_set():
+            return
+        self.draining.set()
+        print(f"[关闭] 停止接收新请求，等待 {self.in_flight()} 个请求结束 (最多 {self.drain_timeout:.0f}s)", file=sys.stderr)
+
+    def wait_drained(self) -> bool:
+        deadline = time.monotonic() + self.drain_timeout
+        while self.in_flight() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        remaining = self.in_flight()
+        if remaining:
+            print(f"[关闭] 超过期限，仍有 {remaining} 个请求未结束", file=sys.stderr)
+        return not remaining
+
+    def close(self):
+        if bridge:
+            for account in bridge.accounts:
+                account.pool.close()
+        self.flush()
+
+    async def aclose(self):
+        if bridge:
+            for account in bridge.accounts:
+                if account.apool is not None:
+                    await account.apool.close()
+                account.pool.close()
+        self.flush()
+
+    def flush(self):
+        """把最终指标写到 PROXY_METRICS_DUMP (若设置)，并在日志里留一行摘要"""
+        if self.metrics_dump:
+            tmp = self.metrics_dump + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(METRICS.render())
+            os.replace(tmp, self.metrics_dump)
+        dumped = f"，指标已写入 {self.metrics_dump}" if self.metrics_dump else ""
+        print(f"[关闭] 共处理 {M_REQUESTS.value():.0f} 个请求{dumped}", file=sys.stderr)
+
+
+lifecycle = Lifecycle()
+
+
+def _shutting_down() -> dict:
+    return {"type": "error", "error": {"type": "api_error", "message": "代理正在关闭，请重试其他实例"}}
+
+
+def _pool_stat(name: str) -> int:
+    return bridge.accounts.pool_stats()[name] if bridge else 0
+
+
+def _rss_bytes() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+METRICS.gauge("proxy_upstream_pool_connections", "Upstream connections (busy + idle)", lambda: _pool_stat("size"))
+METRICS.gauge("proxy_upstream_pool_idle", "Idle upstream connections", lambda: _pool_stat("idle"))
+METRICS.gauge("proxy_sessions", "Sessions in the session table", lambda: len(bridge.sessions) if bridge else 0)
+METRICS.gauge("proxy_admission_in_flight", "Requests admitted to upstream", lambda: bridge.admission.in_flight if bridge else 0)
+METRICS.gauge("proxy_admission_queue_depth", "Requests waiting for admission", lambda: bridge.admission.queued if bridge else 0)
+METRICS.gauge("proxy_accounts_available", "Upstream accounts not in cooldown",
+              lambda: sum(not a.cooling for a in bridge.accounts) if bridge else 0)
+METRICS.gauge("process_resident_memory_bytes", "Resident memory size in bytes", _rss_bytes)
+
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
 @app.route("/v1/messages", methods=["POST"])
 def messages():
     global bridge
     if not bridge:
         return {"error": {"type": "api_error", "message": "Not initialized"}}, 500
     
+    if lifecycle.draining.is_set():
+        return _shutting_down(), 503
+    
     data = request.json
-    return Response(
-        bridge.chat_stream(
-            data.get("messages", []),
-            data.get("model", "claude-3-opus-20240229"),
-            data.get("system")
-        ),
+    messages, model, system = data.get("messages", []), data.get("model", "claude-3-opus-20240229"), data.get("system")
+    tools = {"tools": data.get("tools"), "tool_choice": data.get("tool_choice")}
+    stream = data.get("stream", True)  # 未声明时保持一直以来的流式行为
+    ckey, cached = bridge.cache_lookup(messages, model, system, **tools)
+    if cached:
+        # 命中缓存不占上游名额
+        if not stream:
+            return bridge.cached_message(cached, model)
+        return Response(bridge.replay_stream(cached, model), mimetype="text/event-stream", headers=SSE_HEADERS)
+    
+    key = session_key(request.headers)
+    try:
+        ticket = bridge.admission.acquire(key, request_priority(request.headers))
+    except Overloaded as e:
+        M_ERRORS.labels(e.error_type).inc()
+        return _overloaded(str(e)), 529
+    
+    if not stream:
+        try:
+            status, body = bridge.chat_message(messages, model, system, key, cache_key=ckey, **tools)
+        finally:
+            bridge.admission.release(ticket)
+        return body, status
+    
+    response = Response(
+        bridge.chat_stream(messages, model, system, key, cache_key=ckey, **tools),
         mimetype="text/event-stream",
-        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        headers=SSE_HEADERS
     )
+    # 流结束或客户端断开时释放名额 (生成器可能一次都没被迭代)
+    response.call_on_close(lambda: bridge.admission.release(ticket))
+    return response
+
+
+def _overloaded(message: str) -> dict:
+    return {"type": "error", "error": {"type": "overloaded_error", "message": message}}
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """给负载均衡做就绪检查：关闭中返回 503，让流量先切走"""
+    return _healthz()
+
+
+def _healthz():
+    if lifecycle.draining.is_set():
+        return {"status": "draining", "in_flight": lifecycle.in_flight()}, 503
+    return {"status": "ok"}, 200
 
 
 @app.route("/v1/models", methods=["GET"])
@@ -314,31 +2027,222 @@ def catch_all_api(path):
 
 @app.route("/new", methods=["POST"])
 def new_conversation():
-    """手动新建对话"""
-    global bridge
+    """手动新建对话 (只重置调用方自己的会话)"""
+    return _new_conversation(session_key(request.headers))
+
+
+def _new_conversation(key: str) -> dict:
     if bridge:
-        bridge.new_conversation()
+        bridge.new_conversation(key)
     return {"status": "ok", "message": "New conversation started"}
 
 
-@app.route("/", methods=["GET"])
-def index():
-    return {
+def _status(key: str) -> dict:
+    session = bridge.sessions.peek(key) if bridge else None
+    status = {
         "status": "ok",
-        "current_cid": bridge.current_cid[:20] + "..." if bridge and bridge.current_cid else None,
-        "message_count": bridge.message_count if bridge else 0
+        "session": key,
+        "current_cid": None,
+        "message_count": 0,
+        "sessions": len(bridge.sessions) if bridge else 0,
+        "pool": bridge.accounts.pool_stats() if bridge else None,
+        "accounts": bridge.accounts.stats() if bridge else [],
+        "admission": bridge.admission.stats() if bridge else None
     }
+    if session:
+        status.update(session.info())
+    return status
+
+
+def _metrics() -> dict:
+    return {
+        "tokenizer": bridge.tokens.stats(),
+        "models": bridge.usage.snapshot(),
+        "limits": {
+            "max_messages_per_conversation": bridge.max_messages_per_conversation,
+            "max_tokens_per_conversation": bridge.max_tokens_per_conversation,
+        },
+        "sessions": bridge.sessions.snapshot(),
+        "cache": bridge.cache.stats() if bridge.cache is not None else None,
+    }
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus 文本格式；?format=json 返回用量明细"""
+    if not bridge:
+        return {"error": {"type": "api_error", "message": "Not initialized"}}, 500
+    if request.args.get("format") == "json":
+        return _metrics()
+    return Response(METRICS.render(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.route("/", methods=["GET"])
+def index():
+    return _status(session_key(request.headers))
+
+
+def create_async_app(pool_size: int, pool_idle_timeout: float):
+    """asyncio 版 (aiohttp) 应用，路由与 Flask 版一致"""
+    routes = web.RouteTableDef()
+    
+    @routes.post("/v1/messages")
+    async def messages_async(request):
+        if lifecycle.draining.is_set():
+            return web.json_response(_shutting_down(), status=503)
+        data = await request.json()
+        messages, model, system = data.get("messages", []), data.get("model", "claude-3-opus-20240229"), data.get("system")
+        tools = {"tools": data.get("tools"), "tool_choice": data.get("tool_choice")}
+        stream = data.get("stream", True)
+        ckey, cached = bridge.cache_lookup(messages, model, system, **tools)
+        if cached:
+            if not stream:
+                return web.json_response(bridge.cached_message(cached, model))
+            return await _write_async(request, _aiter(bridge.replay_stream(cached, model)))
+        
+        key = session_key(request.headers)
+        try:
+            ticket = await bridge.admission.aacquire(key, request_priority(request.headers))
+        except Overloaded as e:
+            M_ERRORS.labels(e.error_type).inc()
+            return web.json_response(_overloaded(str(e)), status=529)
+        try:
+            if not stream:
+                status, body = await bridge.achat_message(messages, model, system, key, cache_key=ckey, **tools)
+                return web.json_response(body, status=status)
+            return await _write_async(request, bridge.achat_stream(messages, model, system, key, cache_key=ckey, **tools))
+        finally:
+            bridge.admission.release(ticket)
+    
+    async def _aiter(frames):
+        for frame in frames:
+            yield frame
+    
+    async def _write_async(request, frames):
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", **SSE_HEADERS})
+        await resp.prepare(request)
+        try:
+            async for frame in frames:
+                await resp.write(frame)
+        except (ConnectionResetError, asyncio.CancelledError):
+            M_ERRORS.labels("client_disconnect").inc()
+            raise
+        await resp.write_eof()
+        return resp
+    
+    @routes.get("/v1/models")
+    async def models_async(request):
+        return web.json_response(models())
+    
+    @routes.route("*", "/api/{path:.*}")
+    async def catch_all_api_async(request):
+        return web.json_response({"status": "ok"})
+    
+    @routes.post("/new")
+    async def new_conversation_async(request):
+        return web.json_response(_new_conversation(session_key(request.headers)))
+    
+    @routes.get("/metrics")
+    async def metrics_async(request):
+        if request.query.get("format") == "json":
+            return web.json_response(_metrics())
+        return web.Response(body=METRICS.render().encode(), headers={"Content-Type": PROMETHEUS_CONTENT_TYPE})
+    
+    @routes.get("/healthz")
+    async def healthz_async(request):
+        body, status = _healthz()
+        return web.json_response(body, status=status)
+    
+    @routes.get("/")
+    async def index_async(request):
+        return web.json_response(_status(session_key(request.headers)))
+    
+    async def on_startup(app):
+        for account in bridge.accounts:
+            account.apool = AsyncConnectionPool(
+                bridge.ws_url,
+                account.cookies,
+                bridge.headers,
+                max_size=pool_size,
+                idle_timeout=pool_idle_timeout,
+            )
+    
+    async def on_shutdown(app):
+        # aiohttp 已停止监听，随后最多等 shutdown_timeout 让在途请求结束
+        lifecycle.begin_drain()
+    
+    async def on_cleanup(app):
+        await lifecycle.aclose()
+    
+    aio_app = web.Application()
+    aio_app.add_routes(routes)
+    aio_app.on_startup.append(on_startup)
+    aio_app.on_shutdown.append(on_shutdown)
+    aio_app.on_cleanup.append(on_cleanup)
+    return aio_app
 
 
 def main():
     global bridge
     cookies = os.environ.get("GENSPARK_COOKIES")
-    if not cookies:
-        print("请设置 GENSPARK_COOKIES 环境变量")
+    accounts_file = os.environ.get("GENSPARK_ACCOUNTS_FILE")
+    accounts = load_accounts(accounts_file) if accounts_file else None
+    if not cookies and not accounts:
+        print("请设置 GENSPARK_COOKIES 或 GENSPARK_ACCOUNTS_FILE 环境变量")
+        sys.exit(1)
+    
+    use_async = "--async" in sys.argv[1:] or os.environ.get("PROXY_ASYNC") == "1"
+    if use_async and aiohttp is None:
+        print("asyncio 模式需要 aiohttp: pip install aiohttp")
         sys.exit(1)
     
-    bridge = GensparkBridge(cookies=cookies)
+    pool_size = int(os.environ.get("PROXY_POOL_SIZE", 64 if use_async else 8))
+    pool_idle_timeout = float(os.environ.get("PROXY_POOL_IDLE_TIMEOUT", 120))
+    bridge = GensparkBridge(
+        cookies=cookies,
+        pool_size=pool_size,
+        pool_idle_timeout=pool_idle_timeout,
+        max_sessions=int(os.environ.get("PROXY_MAX_SESSIONS", 1024)),
+        session_ttl=float(os.environ.get("PROXY_SESSION_TTL", 3600)),
+        coalesce_chars=int(os.environ.get("PROXY_COALESCE_CHARS", 4096)),
+        coalesce_wait=float(os.environ.get("PROXY_COALESCE_MS", 0)) / 1000,
+        tokenizer=os.environ.get("PROXY_TOKENIZER", "approx"),
+        max_tokens_per_conversation=int(os.environ.get("PROXY_MAX_CONVERSATION_TOKENS", 0)),
+        max_in_flight=int(os.environ.get("PROXY_MAX_IN_FLIGHT", 0)) or None,
+        max_queue=int(os.environ.get("PROXY_MAX_QUEUE", 256)),
+        queue_timeout=float(os.environ.get("PROXY_QUEUE_TIMEOUT", 60)),
+        accounts=accounts,
+        account_strategy=os.environ.get("PROXY_ACCOUNT_STRATEGY", "least_loaded"),
+        account_cooldown=float(os.environ.get("PROXY_ACCOUNT_COOLDOWN", 60)),
+        account_max_in_flight=int(os.environ.get("PROXY_ACCOUNT_MAX_IN_FLIGHT", 0)) or None,
+        account_sticky_wait=float(os.environ.get("PROXY_ACCOUNT_STICKY_WAIT", 5)),
+        ws_url=os.environ.get("GENSPARK_WS_URL"),  # 压测时指向 proxy_mock_upstream.py
+        cache=ResponseCache(
+            ttl=float(os.environ.get("PROXY_CACHE_TTL", 3600)),
+            max_entries=int(os.environ.get("PROXY_CACHE_MAX_ENTRIES", 1024)),
+            max_bytes=int(float(os.environ.get("PROXY_CACHE_MAX_MB", 64)) * 2**20),
+            disk_dir=os.environ.get("PROXY_CACHE_DIR"),  # 不设则只用内存层
+            disk_max_bytes=int(float(os.environ.get("PROXY_CACHE_DISK_MAX_MB", 512)) * 2**20),
+        ) if os.environ.get("PROXY_CACHE") == "1" else None,
+        continuation_delay=float(os.environ.get("PROXY_CONTINUATION_DELAY_MS", 0)) / 1000,
+        prewarm_chars=int(os.environ.get("PROXY_PREWARM_CHARS", 2000)),
+    )
+    workers = int(_arg_value("--workers") or os.environ.get("PROXY_WORKERS", 1))
+    store_kind = os.environ.get("PROXY_SESSION_STORE", "sqlite" if workers > 1 else "memory")
+    if store_kind == "sqlite":
+        bridge.store = SQLiteSessionStore(
+            os.environ.get("PROXY_SESSION_DB", "~/.cache/genspark-proxy/sessions.db"),
+            ttl=float(os.environ.get("PROXY_SESSION_TTL", 3600)),
+            accounts=bridge.accounts,
+        )
+    elif workers > 1:
+        print("[警告] 多 worker 使用内存会话存储，同一客户端的请求落到不同 worker 时无法复用 cid", file=sys.stderr)
     port = int(os.environ.get("PORT", 8080))
+    lifecycle.drain_timeout = float(os.environ.get("PROXY_DRAIN_TIMEOUT", 30))
+    lifecycle.metrics_dump = os.environ.get("PROXY_METRICS_DUMP")
     
     print("=" * 55)
     print("🚀 Genspark → Claude Code 代理 (会话复用版)")
@@ -346,16 +2250,135 @@ def main():
     print()
     print("特性:")
     print("  ✓ 复用对话，避免刷屏历史记录")
+    print("  ✓ 按 x-session-id / x-api-key 分会话，多客户端互不干扰")
     print("  ✓ 强制使用 Claude 4.5 Opus")
     print("  ✓ 自动续写长回复")
+    print(f"  ✓ 上游连接池 (每个账号最多 {pool_size} 条常驻连接)")
+    print(f"  ✓ 账号池: {len(bridge.accounts)} 个账号，{bridge.accounts.strategy} 调度，"
+          f"每个账号最多 {bridge.accounts.max_in_flight} 个并发，出错/限流自动冷却")
+    print(f"  ✓ 准入控制 (最多 {bridge.admission.max_in_flight} 个并发，超出排队，x-priority 越小越优先)")
+    if bridge.cache is not None:
+        print(f"  ✓ 回复缓存 (TTL {bridge.cache.ttl:.0f}s{'，磁盘: ' + bridge.cache.disk_dir if bridge.cache.disk_dir else ''})")
+    print(f"  ✓ 运行模式: {'asyncio (aiohttp)' if use_async else 'Flask 多线程'}"
+          + (f"，{workers} 个 worker 共享端口" if workers > 1 else ""))
+    print(f"  ✓ 会话存储: {bridge.store.name}" + (f" ({bridge.store.path})" if store_kind == "sqlite" else ""))
     print()
     print("Claude Code 配置:")
     print(f'  ~/.claude/settings.json 已配置')
     print()
-    print(f"手动新建对话: curl -X POST http://localhost:{port}/new")
+    print(f"手动新建对话: curl -X POST http://localhost:{port}/new  (可带 x-session-id 头)")
+    print(f"指标:         curl http://localhost:{port}/metrics  (?format=json 看用量明细)")
+    print(f"关闭:         SIGTERM 后最多等 {lifecycle.drain_timeout:.0f}s 让在途请求结束，/healthz 同时返回 503")
     print("=" * 55)
     
-    app.run(host="0.0.0.0", port=port, threaded=True)
+    def run(sock=None):
+        if use_async:
+            web.run_app(
+                create_async_app(pool_size, pool_idle_timeout),
+                host=None if sock else "0.0.0.0", port=None if sock else port, sock=sock, print=None,
+                shutdown_timeout=lifecycle.drain_timeout,
+            )
+        else:
+            serve(port, sock)
+    
+    if workers > 1:
+        prefork(workers, port, run)
+    else:
+        run()
+
+
+def _arg_value(name: str):
+    """取 --name N 或 --name=N 形式的命令行参数"""
+    args = sys.argv[1:]
+    for i, arg in enumerate(args):
+        if arg == name and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith(name + "="):
+            return arg.split("=", 1)[1]
+    return None
+
+
+def prefork(workers: int, port: int, run):
+    """pre-fork: 主进程监听端口后 fork 出 worker，共享同一个 socket 由内核分发连接
+
+    worker 异常退出会被重新拉起；主进程收到 SIGTERM/SIGINT 时转发给所有 worker，
+    各自排空后退出。
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(1024)
+    sock.set_inheritable(True)
+    children = {}
+    stopping = False
+    
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                run(sock)
+            except BaseException as e:
+                print(f"[worker {index}] 异常退出: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+        print(f"[worker {index}] pid {pid}", file=sys.stderr)
+    
+    def on_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    
+    for index in range(workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is not None and not stopping:
+            print(f"[worker {index}] pid {pid} 退出 (status {status})，重新启动", file=sys.stderr)
+            time.sleep(1)
+            spawn(index)
+    sock.close()
+
+
+def serve(port: int, sock: socket.socket = None):
+    """Flask 多线程模式；用可关闭的 werkzeug server 代替 app.run，SIGTERM 时排空后再退出"""
+    from werkzeug.serving import make_server
+    
+    server = make_server("0.0.0.0", port, app, threaded=True, fd=sock.fileno() if sock else None)
+    
+    def drain_and_stop():
+        lifecycle.begin_drain()
+        lifecycle.wait_drained()
+        server.shutdown()
+    
+    def on_signal(signum, frame):
+        if lifecycle.draining.is_set():
+            print("[关闭] 再次收到信号，立即退出", file=sys.stderr)
+            os._exit(1)
+        # serve_forever 在主线程里，shutdown 必须从别的线程调用
+        threading.Thread(target=drain_and_stop, daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        lifecycle.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+proxy.py 压测: 以 N 个并发流打 /v1/messages，统计吞吐、TTFT 分位数和每流内存
+
+每个并发 worker 用独立的 x-session-id，互不串行。内存取自代理 /metrics 的
+process_resident_memory_bytes: 压测前取基线，压测中持续采样峰值，
+(峰值 - 基线) / 并发数 即每流内存。
+
+可设阈值 (--max-ttft-p99 / --max-error-rate / --min-throughput)，超出时退出码为 1，
+便于在 CI 里发现回归。
+
+用法:
+  python proxy_mock_upstream.py --port 9901 &
+  GENSPARK_WS_URL=ws://127.0.0.1:9901/conversation/go GENSPARK_COOKIES=x python proxy.py &
+  python proxy_loadtest.py -c 50 -n 500
+"""
+
+import argparse
+import http.client
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+class LoadTest:
+    def __init__(self, url: str, concurrency: int, requests: int, prompt: str,
+                 model: str = "claude-3-opus-20240229", timeout: float = 300):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.concurrency = concurrency
+        self.requests = requests
+        self.body = json.dumps({
+            "model": model,
+            "max_tokens": 4096,
+            "stream": True,
+            "messages": [{"role": "user", "content": prompt}],
+        })
+        self.timeout = timeout
+        self.results = []
+        self.peak_rss = 0
+        self._next = 0
+        self._lock = threading.Lock()
+        self._running = False
+
+    def _take(self) -> bool:
+        with self._lock:
+            if self._next >= self.requests:
+                return False
+            self._next += 1
+            return True
+
+    def _one(self, conn: http.client.HTTPConnection, worker: int) -> dict:
+        started = time.monotonic()
+        result = {"ttft": None, "duration": 0.0, "chars": 0, "error": None}
+        conn.request("POST", "/v1/messages", self.body, {
+            "Content-Type": "application/json",
+            "x-session-id": f"loadtest-{worker}",
+        })
+        resp = conn.getresponse()
+        if resp.status != 200:
+            result["error"] = f"http_{resp.status}"
+            resp.read()
+            return result
+        event = None
+        for raw in resp:
+            line = raw.decode("utf-8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: ") and event == "content_block_delta":
+                delta = json.loads(line[6:])["delta"]
+                if result["ttft"] is None:
+                    result["ttft"] = time.monotonic() - started
+                result["chars"] += len(delta.get("text") or delta.get("partial_json") or "")
+            elif line.startswith("data: ") and event == "error":
+                result["error"] = json.loads(line[6:])["error"].get("type", "error")
+        result["duration"] = time.monotonic() - started
+        return result
+
+    def _worker(self, worker: int):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        while self._take():
+            try:
+                result = self._one(conn, worker)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                result = {"ttft": None, "duration": 0.0, "chars": 0, "error": type(e).__name__}
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            with self._lock:
+                self.results.append(result)
+        conn.close()
+
+    def rss(self) -> int:
+        """读代理 /metrics 里的常驻内存，取不到时返回 0"""
+        try:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=5)
+            conn.request("GET", "/metrics")
+            text = conn.getresponse().read().decode()
+            conn.close()
+        except (OSError, http.client.HTTPException):
+            return 0
+        for line in text.splitlines():
+            if line.startswith("process_resident_memory_bytes "):
+                return int(float(line.split()[1]))
+        return 0
+
+    def _sample_rss(self):
+        while self._running:
+            self.peak_rss = max(self.peak_rss, self.rss())
+            time.sleep(0.2)
+
+    def run(self) -> dict:
+        baseline = self.rss()
+        self._running = True
+        sampler = threading.Thread(target=self._sample_rss, daemon=True)
+        sampler.start()
+        started = time.monotonic()
+        workers = [threading.Thread(target=self._worker, args=(i,)) for i in range(self.concurrency)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.monotonic() - started
+        self._running = False
+        sampler.join()
+        return self.report(elapsed, baseline)
+
+    def report(self, elapsed: float, baseline: int) -> dict:
+        ok = [r for r in self.results if not r["error"]]
+        errors = {}
+        for r in self.results:
+            if r["error"]:
+                errors[r["error"]] = errors.get(r["error"], 0) + 1
+        ttft = [r["ttft"] for r in ok if r["ttft"] is not None]
+        durations = [r["duration"] for r in ok]
+        peak = max(self.peak_rss, baseline)
+        return {
+            "concurrency": self.concurrency,
+            "requests": len(self.results),
+            "ok": len(ok),
+            "errors": errors,
+            "error_rate": round(1 - len(ok) / len(self.results), 4) if self.results else 0,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else 0,
+            "throughput_chars_s": round(sum(r["chars"] for r in ok) / elapsed, 1) if elapsed else 0,
+            "ttft_ms": {f"p{p}": round(percentile(ttft, p) * 1000, 1) for p in (50, 90, 99)},
+            "duration_ms": {f"p{p}": round(percentile(durations, p) * 1000, 1) for p in (50, 90, 99)},
+            "rss_baseline_mb": round(baseline / 2**20, 1),
+            "rss_peak_mb": round(peak / 2**20, 1),
+            "rss_per_stream_kb": round((peak - baseline) / 1024 / self.concurrency, 1) if baseline else None,
+        }
+
+
+def print_report(report: dict):
+    print(f"并发 {report['concurrency']}，请求 {report['requests']}，成功 {report['ok']}，耗时 {report['elapsed_s']}s")
+    print(f"吞吐: {report['throughput_rps']} req/s, {report['throughput_chars_s']} chars/s")
+    ttft, dur = report["ttft_ms"], report["duration_ms"]
+    print(f"TTFT (ms):  p50 {ttft['p50']}  p90 {ttft['p90']}  p99 {ttft['p99']}")
+    print(f"耗时 (ms):  p50 {dur['p50']}  p90 {dur['p90']}  p99 {dur['p99']}")
+    print(f"内存: 基线 {report['rss_baseline_mb']} MB，峰值 {report['rss_peak_mb']} MB，"
+          f"每流 {report['rss_per_stream_kb']} KB")
+    if report["errors"]:
+        print(f"错误: {report['errors']} (错误率 {report['error_rate']:.2%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="proxy.py 压测")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="代理地址")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="并发流数")
+    parser.add_argument("-n", "--requests", type=int, default=100, help="总请求数")
+    parser.add_argument("--prompt", default="hello", help="请求内容 (带 TRUNC 可触发模拟上游的续写)")
+    parser.add_argument("--timeout", type=float, default=300, help="单个请求超时 (秒)")
+    parser.add_argument("--json", action="store_true", help="输出 JSON")
+    parser.add_argument("--max-ttft-p99", type=float, help="TTFT p99 上限 (ms)，超出则退出码为 1")
+    parser.add_argument("--max-error-rate", type=float, help="错误率上限 (0-1)")
+    parser.add_argument("--min-throughput", type=float, help="吞吐下限 (req/s)")
+    args = parser.parse_args()
+
+    test = LoadTest(args.url, args.concurrency, args.requests, args.prompt, timeout=args.timeout)
+    report = test.run()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    failures = []
+    if args.max_ttft_p99 is not None and report["ttft_ms"]["p99"] > args.max_ttft_p99:
+        failures.append(f"TTFT p99 {report['ttft_ms']['p99']}ms > {args.max_ttft_p99}ms")
+    if args.max_error_rate is not None and report["error_rate"] > args.max_error_rate:
+        failures.append(f"错误率 {report['error_rate']} > {args.max_error_rate}")
+    if args.min_throughput is not None and report["throughput_rps"] < args.min_throughput:
+        failures.append(f"吞吐 {report['throughput_rps']} req/s < {args.min_throughput}")
+    for failure in failures:
+        print(f"[回归] {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
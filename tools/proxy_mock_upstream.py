@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+本地模拟上游 (替代 wss://vear.com/conversation/go)，用于压测和回归 proxy.py
+
+协议与真实上游一致: 客户端发 {"uid", "mid", "q", "m", "ms", "t": "m", "cid"?}，
+服务端依次回 {"t": "s", "cid"} → {"t": "m", "c"}* → {"t": "n"}，出错时回 {"t": "e", "c"}。
+
+可调参数:
+  --latency        首帧前的延迟 (ms)
+  --chunk-delay    相邻增量之间的延迟 (ms)
+  --chunk-size     每帧字符数
+  --reply-chars    每次回复的字符数
+  --truncate-rate  以该概率返回一个没闭合的代码块，触发代理续写
+  --error-rate     以该概率返回 t=e 错误帧
+  --rate-limit-rate 以该概率返回限流错误 (触发账号冷却)
+  --drop-rate      以该概率在回复中途直接断开连接
+
+提示词里带 TRUNC / ERR / RATELIMIT / DROP 时必定触发对应行为，便于写确定性的检查；
+带 TOOLCALL 且附带了工具说明时，回复一个调用第一个工具的 <tool_use> 块。
+GET /stats 返回连接数、消息数和各类注入次数。
+
+用法:
+  python proxy_mock_upstream.py --port 9901 --latency 200 --chunk-delay 20
+  GENSPARK_WS_URL=ws://127.0.0.1:9901/conversation/go GENSPARK_COOKIES=x python proxy.py
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import re
+import sys
+
+from aiohttp import web, WSMsgType
+
+_FILLER = "The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸跳过了懒狗。\n"
+_TRUNCATED = "下面是代码:\n```python\ndef handler(event):\n    return {\"items\": [1, 2, "
+_CONTINUED = "3]}\n```\n完成。"
+_FIRST_TOOL = re.compile(r"^Available tools:\n- ([^:\n]+)", re.M)
+
+
+class MockUpstream:
+    def __init__(self, latency: float = 0, chunk_delay: float = 0.005, chunk_size: int = 8,
+                 reply_chars: int = 400, truncate_rate: float = 0, error_rate: float = 0,
+                 rate_limit_rate: float = 0, drop_rate: float = 0, seed: int = None):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.reply_chars = reply_chars
+        self.truncate_rate = truncate_rate
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self._cids = itertools.count(1)
+        self.stats = {"connections": 0, "open": 0, "messages": 0, "truncated": 0,
+                      "errors": 0, "rate_limited": 0, "dropped": 0}
+
+    def _roll(self, rate: float, marker: str, prompt: str) -> bool:
+        return marker in prompt or (rate > 0 and self.random.random() < rate)
+
+    def _reply(self, prompt: str) -> str:
+        if prompt.startswith("继续"):
+            return _CONTINUED
+        tool = _FIRST_TOOL.search(prompt)
+        if tool and "TOOLCALL" in prompt.rsplit("Human:", 1)[-1]:
+            args = json.dumps({"query": "mock", "n": 3, "tags": ["a", "b"]})
+            return f'好的，我来调用工具。\n<tool_use name="{tool.group(1)}" id="toolu_mock{next(self._cids)}">{args}</tool_use>'
+        if "<tool_result" in prompt:
+            return "工具返回了结果，完成。"
+        body = (_FILLER * (self.reply_chars // len(_FILLER) + 1))[:self.reply_chars]
+        if self._roll(self.truncate_rate, "TRUNC", prompt):
+            self.stats["truncated"] += 1
+            return body + _TRUNCATED
+        return body
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.stats["connections"] += 1
+        self.stats["open"] += 1
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    break
+                if not await self._answer(ws, json.loads(msg.data)):
+                    break
+        finally:
+            self.stats["open"] -= 1
+        return ws
+
+    async def _answer(self, ws, data: dict) -> bool:
+        """回复一条消息；返回 False 表示模拟断线"""
+        self.stats["messages"] += 1
+        prompt = data.get("q", "")
+        cid = data.get("cid") or f"mock-cid-{next(self._cids)}"
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        await ws.send_str(json.dumps({"t": "s", "cid": cid}))
+
+        if self._roll(self.rate_limit_rate, "RATELIMIT", prompt):
+            self.stats["rate_limited"] += 1
+            await ws.send_str(json.dumps({"t": "e", "c": "Rate limit exceeded, too many requests"}))
+            return True
+        if self._roll(self.error_rate, "ERR", prompt):
+            self.stats["errors"] += 1
+            await ws.send_str(json.dumps({"t": "e", "c": "mock upstream error"}))
+            return True
+
+        text = self._reply(prompt)
+        drop_at = len(text) // 2 if self._roll(self.drop_rate, "DROP", prompt) else None
+        for i in range(0, len(text), self.chunk_size):
+            if drop_at is not None and i >= drop_at:
+                self.stats["dropped"] += 1
+                await ws.close()
+                return False
+            await ws.send_str(json.dumps({"t": "m", "c": text[i:i + self.chunk_size]}))
+            if self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+        await ws.send_str(json.dumps({"t": "n"}))
+        return True
+
+    def app(self) -> web.Application:
+        async def stats(request):
+            return web.json_response(self.stats)
+
+        app = web.Application()
+        app.router.add_get("/conversation/go", self.handle)
+        app.router.add_get("/stats", stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="proxy.py 的本地模拟上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9901)
+    parser.add_argument("--latency", type=float, default=0, help="首帧延迟 (ms)")
+    parser.add_argument("--chunk-delay", type=float, default=5, help="增量间隔 (ms)")
+    parser.add_argument("--chunk-size", type=int, default=8, help="每帧字符数")
+    parser.add_argument("--reply-chars", type=int, default=400, help="每次回复的字符数")
+    parser.add_argument("--truncate-rate", type=float, default=0, help="返回截断代码块的概率")
+    parser.add_argument("--error-rate", type=float, default=0, help="返回错误帧的概率")
+    parser.add_argument("--rate-limit-rate", type=float, default=0, help="返回限流错误的概率")
+    parser.add_argument("--drop-rate", type=float, default=0, help="中途断开连接的概率")
+    parser.add_argument("--seed", type=int, help="随机种子，便于复现")
+    args = parser.parse_args()
+
+    mock = MockUpstream(
+        latency=args.latency / 1000,
+        chunk_delay=args.chunk_delay / 1000,
+        chunk_size=args.chunk_size,
+        reply_chars=args.reply_chars,
+        truncate_rate=args.truncate_rate,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        drop_rate=args.drop_rate,
+        seed=args.seed,
+    )
+    print(f"[mock] ws://{args.host}:{args.port}/conversation/go", file=sys.stderr)
+    web.run_app(mock.app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+内容寻址的回复缓存 (内存 + 磁盘两级)
+
+Agent 循环里重试、重跑工具时经常原样重发同一份 system prompt 和历史，
+这类请求的回复直接从缓存回放，不再占用上游。
+
+  - 键: 归一化后的各轮摘要 + 模型配置的摘要，由调用方算好传入
+  - 内存层: LRU，按条数和总字节数双重限制
+  - 磁盘层 (可选): 每条一个 JSON 文件，写临时文件后原子替换；
+    按总字节数淘汰最旧的文件，命中后提升到内存层
+  - 两层都有 TTL，过期条目在读到时删除
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(parts: list) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = 3600, max_entries: int = 1024, max_bytes: int = 64 << 20,
+                 disk_dir: str = None, disk_max_bytes: int = 512 << 20):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = os.path.expanduser(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()  # key -> (created, size, entry)
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> (created, size)，按写入时间排序
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _scan_disk(self):
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.disk_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name[:-5], st.st_size))
+        for mtime, key, size in sorted(files):
+            self._disk[key] = (mtime, size)
+            self._disk_bytes += size
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _remember(self, key: str, created: float, size: int, entry: dict):
+        """放入内存层，调用方持有锁"""
+        old = self._memory.pop(key, None)
+        if old:
+            self._memory_bytes -= old[1]
+        self._memory[key] = (created, size, entry)
+        self._memory_bytes += size
+        while self._memory and (len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes):
+            _, (_, evicted, _) = self._memory.popitem(last=False)
+            self._memory_bytes -= evicted
+
+    def _drop_disk(self, key: str):
+        created_size = self._disk.pop(key, None)
+        if created_size:
+            self._disk_bytes -= created_size[1]
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if self._expired(item[0]):
+                    del self._memory[key]
+                    self._memory_bytes -= item[1]
+                else:
+                    self._memory.move_to_end(key)
+                    self.hits["memory"] += 1
+                    return item[2]
+            meta = self._disk.get(key) if self.disk_dir else None
+            if meta is None:
+                self.misses += 1
+                return None
+            if self._expired(meta[0]):
+                self._drop_disk(key)
+                self.misses += 1
+                return None
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self._drop_disk(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self._remember(key, meta[0], meta[1], entry)
+            self.hits["disk"] += 1
+        return entry
+
+    def put(self, key: str, entry: dict):
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, len(data), entry)
+        if not self.disk_dir:
+            return
+        tmp = self._path(key) + f".{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            old = self._disk.pop(key, None)
+            if old:
+                self._disk_bytes -= old[1]
+            self._disk[key] = (created, len(data))
+            self._disk_bytes += len(data)
+            while self._disk and self._disk_bytes > self.disk_max_bytes:
+                self._drop_disk(next(iter(self._disk)))
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "disk_entries": len(self._disk),
+            "disk_bytes": self._disk_bytes,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+        }
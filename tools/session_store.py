@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+会话状态存储 (cid、消息计数、前缀摘要、账号、token 统计)
+
+  - MemorySessionStore  单进程默认实现，状态只在 SessionTable 里，占用和写回都是空操作
+  - SQLiteSessionStore  同一台机器上的多个 worker 共享:
+      * 状态存在 SQLite (WAL)，请求开始时 claim (读出状态并写入占用租约)，结束时 save
+      * claim / save 各是一个很短的 BEGIN IMMEDIATE 事务，不跨上游 I/O 持锁；
+        同一会话的 cid 被别的 worker 占用时 claim 直接返回 False，由调用方改用临时对话
+      * save 按租约做 compare-and-set，租约已过期被别人接手或会话被重置时不覆盖
+      * 连接按线程、按进程惰性创建，fork 之后自动重连
+
+SessionTable 里的 Session 仍然是每个 worker 各自的缓存，存储才是权威。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class MemorySessionStore:
+    name = "memory"
+
+    def claim(self, session) -> bool:
+        return True
+
+    def save(self, session):
+        pass
+
+    def reset(self, key: str = None):
+        pass
+
+
+class SQLiteSessionStore:
+    name = "sqlite"
+
+    _FIELDS = ("cid", "message_count", "prefix", "account", "input_tokens", "output_tokens",
+               "context_tokens", "created_at", "last_used")
+
+    def __init__(self, path: str, ttl: float = 3600, lease_ttl: float = 600, accounts=None):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl  # 占用者崩溃时租约最多保留这么久
+        self.accounts = accounts  # 用于把账号名还原成本进程的 Account
+        self._local = threading.local()
+        self._last_evict = 0.0
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 建表后立即关闭，避免 fork 前留下打开的连接
+        with sqlite3.connect(self.path) as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " key TEXT PRIMARY KEY, cid TEXT, message_count INTEGER, prefix TEXT, account TEXT,"
+                " input_tokens INTEGER, output_tokens INTEGER, context_tokens INTEGER,"
+                " created_at REAL, last_used REAL, lease TEXT, lease_until REAL)"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(sessions)")}
+            for column, kind in (("lease", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    db.execute(f"ALTER TABLE sessions ADD COLUMN {column} {kind}")
+        db.close()
+
+    def _db(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self._local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.db.execute("PRAGMA synchronous=NORMAL")
+            self._local.pid = pid
+        return self._local.db
+
+    def _row(self, session) -> tuple:
+        return (
+            session.cid, session.message_count, json.dumps(session.prefix),
+            session.account.name if session.account else None,
+            session.input_tokens, session.output_tokens, session.context_tokens,
+            session.created_at, time.time(),
+        )
+
+    def claim(self, session) -> bool:
+        """读出会话状态并写入占用租约；别的 worker 正在用这个会话时返回 False"""
+        db = self._db()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                f"SELECT {', '.join(self._FIELDS)}, lease_until FROM sessions WHERE key = ?", (session.key,)
+            ).fetchone()
+            if row is not None and row[-1] and row[-1] > now:
+                db.execute("ROLLBACK")
+                return False
+            if row is None or (self.ttl and now - row[-2] > self.ttl):
+                # 别的 worker 重置或已过期：从头开始
+                session.reset()
+                session.account = None
+            else:
+                data = dict(zip(self._FIELDS, row))
+                session.cid = data["cid"]
+                session.message_count = data["message_count"]
+                session.prefix = json.loads(data["prefix"] or "[]")
+                session.account = self.accounts.get(data["account"]) if self.accounts and data["account"] else None
+                session.input_tokens = data["input_tokens"]
+                session.output_tokens = data["output_tokens"]
+                session.context_tokens = data["context_tokens"]
+                session.created_at = data["created_at"]
+            session.lease = f"{os.getpid()}-{os.urandom(6).hex()}"
+            db.execute(
+                f"INSERT OR REPLACE INTO sessions (key, {', '.join(self._FIELDS)}, lease, lease_until)"
+                f" VALUES (?{', ?' * len(self._FIELDS)}, ?, ?)",
+                (session.key, *self._row(session), session.lease, now + self.lease_ttl),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return True
+
+    def save(self, session):
+        """写回状态并释放租约；租约已不属于本请求 (过期被接手、被重置) 时不写"""
+        lease, session.lease = session.lease, None
+        if lease is None:
+            return
+        db = self._db()
+        db.execute(
+            f"UPDATE sessions SET {', '.join(f + ' = ?' for f in self._FIELDS)}, lease = NULL, lease_until = NULL"
+            " WHERE key = ? AND lease = ?",
+            (*self._row(session), session.key, lease),
+        )
+        now = time.time()
+        if self.ttl and now - self._last_evict > 60:
+            self._last_evict = now
+            db.execute("DELETE FROM sessions WHERE last_used < ? AND (lease_until IS NULL OR lease_until < ?)",
+                       (now - self.ttl, now))
+
+    def reset(self, key: str = None):
+        if key is None:
+            self._db().execute("DELETE FROM sessions")
+        else:
+            self._db().execute("DELETE FROM sessions WHERE key = ?", (key,))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+带缓存的 token 计数器
+
+后端可插拔:
+  - approx   (默认) 内置的离线近似分词: 按 cl100k 的规则预切分，
+             再用常见词/词缀表做最长匹配，无需下载词表
+  - tiktoken 使用 cl100k_base 精确计数 (需要 tiktoken 及其词表)
+
+同一段文本 (例如每次请求都重发的 system prompt 和历史轮次) 只计算一次，
+结果放在 LRU 里，长对话的重复前缀几乎不花时间。
+"""
+
+import hashlib
+import math
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# 与 cl100k_base 相近的预切分：缩写、字母串、最多 3 位数字、标点串、空白；CJK 单字成词
+_PRETOKENIZE = re.compile(
+    r"'(?:s|t|re|ve|m|ll|d)"
+    r"| ?[A-Za-z]+"
+    r"|\d{1,3}"
+    r"|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]"
+    r"| ?[^\sA-Za-z\d\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+"
+    r"|\s+"
+)
+
+# 常见整词 (含前导空格的形式在词表里也是单 token)
+_WORDS = frozenset("""
+a about after all also an and any are as at be because been but by can could
+data def do does else error false file for from function get has have he her
+his how i if import in into is it its just let like make may me more most my
+new no none not null of on one only or other our out over print public return
+self set she so some string such than that the their them then there these
+they this time to true two type up us use value var was we were what when
+where which while who will with would you your class const static void int
+async await try except raise catch throw yield lambda pass break continue
+""".split())
+
+# 常见子词单元，用于把生僻长词切成若干 token
+_UNITS = frozenset("""
+ing tion ment ness able ible ally ence ance ight ould ound ever ous ive ize
+ise ing est ers ies ted ent ant ure ity ory ary per pre pro con com dis sub
+un re in im ex de st th ch sh er ed es ly al le en on an ar or at it is as
+""".split())
+_MAX_UNIT = max(map(len, _UNITS))
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+
+
+@lru_cache(maxsize=65536)
+def _approx_piece(piece: str) -> int:
+    stripped = piece.lstrip(" ")
+    if not stripped:
+        return 1
+    first = stripped[0]
+    if first.isalpha() and first.isascii():
+        word = stripped.lower()
+        if len(word) <= 3 or word in _WORDS:
+            return 1
+        # 贪心最长匹配常见单元，剩余字母按 4 个一组计
+        tokens, i, loose = 0, 0, 0
+        while i < len(word):
+            for size in range(min(_MAX_UNIT, len(word) - i), 1, -1):
+                if word[i:i + size] in _UNITS:
+                    tokens += 1 + math.ceil(loose / 4)
+                    loose = 0
+                    i += size
+                    break
+            else:
+                loose += 1
+                i += 1
+        return max(1, tokens + math.ceil(loose / 4))
+    if first.isspace():
+        return 1
+    if first.isdigit() or len(stripped) == 1 and ord(first) < 0x3040:
+        return 1
+    if _CJK.match(first):
+        return 1
+    # 标点串: 常见的两两合并；其他 unicode 按 utf-8 字节粗估
+    if stripped.isascii():
+        return math.ceil(len(stripped) / 2)
+    return max(1, len(stripped.encode("utf-8")) // 3)
+
+
+def approx_count(text: str) -> int:
+    return sum(_approx_piece(p) for p in _PRETOKENIZE.findall(text))
+
+
+def _tiktoken_backend():
+    import tiktoken
+    enc = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+
+
+class TokenCounter:
+    """线程安全、带 LRU 的 token 计数器"""
+
+    _LONG_TEXT = 256  # 更长的文本用摘要做缓存键，避免缓存持有大字符串
+    name = "custom"
+
+    def __init__(self, backend=None, cache_size: int = 4096):
+        self.backend = backend or approx_count
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def create(cls, name: str = "approx", cache_size: int = 4096) -> "TokenCounter":
+        """按名字选后端: approx / tiktoken / auto (tiktoken 可用就用，否则 approx)"""
+        if name in ("auto", "tiktoken"):
+            try:
+                counter = cls(_tiktoken_backend(), cache_size)
+                counter.name = "tiktoken"
+                return counter
+            except Exception:
+                if name == "tiktoken":
+                    raise
+        counter = cls(approx_count, cache_size)
+        counter.name = "approx"
+        return counter
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        key = text if len(text) <= self._LONG_TEXT else hashlib.sha1(text.encode()).digest()
+        with self._lock:
+            n = self._cache.get(key)
+            if n is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return n
+            self.misses += 1
+        n = self.backend(text)
+        with self._lock:
+            self._cache[key] = n
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    def count_turns(self, turns: list) -> int:
+        """逐轮计数再求和，重复出现的历史轮次直接命中缓存"""
+        return sum(self.count(t) for t in turns)
+
+    def stats(self) -> dict:
+        return {"backend": self.name, "cache_entries": len(self._cache), "hits": self.hits, "misses": self.misses}
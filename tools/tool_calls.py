@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+上游没有原生 tool_use，这里把工具调用编码成带标签的文本，再从流式输出里解析回来
+
+编码 (发给上游):
+  工具说明      一段固定格式的说明 + 每个工具的名字、描述、input_schema
+  tool_use     <tool_use name="NAME" id="ID">{...json...}</tool_use>
+  tool_result  <tool_result id="ID">内容</tool_result>   (出错时带 is_error="true")
+
+解析 (上游 → 客户端):
+  ToolCallParser 逐个增量喂入，产出 ("text", s) / ("tool_start", {id, name}) /
+  ("tool_delta", partial_json) / ("tool_stop", None)。
+  标签被拆在两个增量之间也能识别：可能是标签开头的尾巴先扣住，等下一段再判断。
+  工具参数 JSON 边到边转发，不等整段结束。
+"""
+
+import json
+import random
+import re
+import string
+
+_OPEN = "<tool_use"
+_CLOSE = "</tool_use>"
+_MAX_TAG = 512  # 开始标签超过这个长度仍未闭合，按普通文本处理
+_TAG = re.compile(r'<tool_use(?:\s+[^>]*)?>\Z')
+_ATTR = re.compile(r'(\w+)="([^"]*)"')
+
+
+def tool_id() -> str:
+    return "toolu_" + "".join(random.choices(string.ascii_letters + string.digits, k=24))
+
+
+def _escape_attr(value) -> str:
+    return str(value).replace("&", "&amp;").replace('"', "&quot;")
+
+
+def _unescape_attr(value: str) -> str:
+    return value.replace("&quot;", '"').replace("&amp;", "&")
+
+
+def encode_tools(tools: list, tool_choice: dict = None) -> str:
+    lines = [
+        "Tools: you can call the tools below. To call a tool, output one block per call, exactly in this form:",
+        '<tool_use name="TOOL_NAME" id="toolu_UNIQUE_ID">{"arg": "value"}</tool_use>',
+        "The body must be a single JSON object matching the tool's input_schema. "
+        "After your tool calls, stop and wait: results come back as "
+        '<tool_result id="...">...</tool_result>. Never write tool_result blocks yourself.',
+    ]
+    choice = (tool_choice or {}).get("type")
+    if choice == "any":
+        lines.append("You must call at least one tool.")
+    elif choice == "tool":
+        lines.append(f"You must call the tool \"{tool_choice.get('name')}\".")
+    elif choice == "none":
+        lines.append("Do not call any tool in this reply.")
+    lines.append("")
+    lines.append("Available tools:")
+    for tool in tools:
+        lines.append(f"- {tool.get('name')}: {tool.get('description', '')}".rstrip())
+        lines.append(f"  input_schema: {json.dumps(tool.get('input_schema', {}), ensure_ascii=False, sort_keys=True)}")
+    return "\n".join(lines)
+
+
+def encode_tool_use(block: dict) -> str:
+    # 键排序后编码：客户端回传的 input 键序可能变了，摘要仍要一致
+    return (
+        f'<tool_use name="{_escape_attr(block.get("name", ""))}" id="{_escape_attr(block.get("id", ""))}">'
+        f'{json.dumps(block.get("input", {}), ensure_ascii=False, sort_keys=True)}</tool_use>'
+    )
+
+
+def encode_tool_result(block: dict) -> str:
+    content = block.get("content", "")
+    if isinstance(content, list):
+        content = "\n".join(b.get("text", "") if isinstance(b, dict) else str(b) for b in content)
+    error = ' is_error="true"' if block.get("is_error") else ""
+    return f'<tool_result id="{_escape_attr(block.get("tool_use_id", ""))}"{error}>{content}</tool_result>'
+
+
+def _holdback(text: str, marker: str) -> int:
+    """text 末尾可能是 marker 开头的最长长度"""
+    for n in range(min(len(marker) - 1, len(text)), 0, -1):
+        if marker.startswith(text[-n:]):
+            return n
+    return 0
+
+
+class ToolCallParser:
+    TEXT, TAG, BODY = range(3)
+
+    def __init__(self):
+        self.mode = self.TEXT
+        self.buf = ""
+
+    def feed(self, text: str) -> list:
+        self.buf += text
+        events = []
+        while self.buf:
+            if self.mode == self.TEXT:
+                i = self.buf.find(_OPEN)
+                if i < 0:
+                    keep = _holdback(self.buf, _OPEN)
+                    emit, self.buf = self.buf[:len(self.buf) - keep], self.buf[len(self.buf) - keep:]
+                    if emit:
+                        events.append(("text", emit))
+                    break
+                if i:
+                    events.append(("text", self.buf[:i]))
+                self.buf = self.buf[i:]
+                self.mode = self.TAG
+            elif self.mode == self.TAG:
+                j = self.buf.find(">")
+                if j < 0:
+                    if len(self.buf) > _MAX_TAG:
+                        self._not_a_tag(events, len(self.buf))
+                        continue
+                    break
+                tag = self.buf[:j + 1]
+                if not _TAG.match(tag):
+                    self._not_a_tag(events, len(_OPEN))
+                    continue
+                attrs = {k: _unescape_attr(v) for k, v in _ATTR.findall(tag)}
+                events.append(("tool_start", {"id": attrs.get("id") or tool_id(), "name": attrs.get("name", "")}))
+                self.buf = self.buf[j + 1:]
+                self.mode = self.BODY
+            else:
+                k = self.buf.find(_CLOSE)
+                if k < 0:
+                    keep = _holdback(self.buf, _CLOSE)
+                    emit, self.buf = self.buf[:len(self.buf) - keep], self.buf[len(self.buf) - keep:]
+                    if emit:
+                        events.append(("tool_delta", emit))
+                    break
+                if k:
+                    events.append(("tool_delta", self.buf[:k]))
+                events.append(("tool_stop", None))
+                self.buf = self.buf[k + len(_CLOSE):]
+                self.mode = self.TEXT
+        return events
+
+    def _not_a_tag(self, events: list, n: int):
+        events.append(("text", self.buf[:n]))
+        self.buf = self.buf[n:]
+        self.mode = self.TEXT
+
+    def flush(self) -> list:
+        """输出结束：吐出扣住的文本，未闭合的工具调用就地结束"""
+        buf, self.buf = self.buf, ""
+        if self.mode == self.BODY:
+            self.mode = self.TEXT
+            return ([("tool_delta", buf)] if buf else []) + [("tool_stop", None)]
+        self.mode = self.TEXT
+        return [("text", buf)] if buf else []
@@ -2,6 +2,11 @@
 """
 Genspark CLI - 功能完整版
 支持：文件读取、自定义 prompt、管道输入、自动化工作流
+
+守护进程模式 (vear --daemon):
+  常驻进程持有已握手的上游连接，监听 Unix socket (默认 ~/.config/genspark/vear.sock，
+  可用 VEAR_SOCKET 覆盖)。之后的 vear 调用发现 socket 可连就把请求转给它，
+  省掉每次的 WebSocket 握手；守护进程不在时照常直连。--no-daemon 强制直连。
 """
 
 import websocket
@@ -14,12 +19,104 @@ import random
 import string
 import argparse
 import glob
+import hashlib
+import mmap
+import signal
+import socket
+import socketserver
+import sqlite3
+from collections import OrderedDict
 from pathlib import Path
 
+class ContextStore:
+    """-c 的会话上下文：按名字存多条对话线程 (cid、模型、轮数、最后使用时间)
+
+    存在 ~/.config/genspark/context.db (SQLite, WAL)，每次写入是一条 UPSERT，
+    并行的 vear -c --thread X 互不覆盖。超过 max_age 未用或超出 max_threads 条
+    (按最后使用时间) 的线程被淘汰。旧的 context.json 首次打开时迁入 default 线程。
+    """
+
+    def __init__(self, path: Path = None, max_threads: int = 200, max_age: float = 30 * 86400):
+        directory = Path("~/.config/genspark").expanduser()
+        directory.mkdir(parents=True, exist_ok=True)
+        self.path = path or directory / "context.db"
+        self.max_threads = max_threads
+        self.max_age = max_age
+        self.db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS threads ("
+            " name TEXT PRIMARY KEY, model TEXT, cid TEXT, turns INTEGER,"
+            " created_at REAL, last_used REAL)"
+        )
+        self._migrate(directory / "context.json")
+
+    def _migrate(self, legacy: Path):
+        if not legacy.exists():
+            return
+        try:
+            with open(legacy) as f:
+                ctx = json.load(f)
+            if ctx.get("cid"):
+                ts = ctx.get("ts") or time.time()
+                self.db.execute(
+                    "INSERT OR IGNORE INTO threads VALUES ('default', ?, ?, 1, ?, ?)",
+                    (ctx.get("model"), ctx["cid"], ts, ts),
+                )
+            legacy.rename(legacy.with_name("context.json.migrated"))
+        except (OSError, ValueError):
+            pass
+
+    def get(self, name: str):
+        row = self.db.execute(
+            "SELECT model, cid, turns, last_used FROM threads WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None or (self.max_age and time.time() - row[3] > self.max_age):
+            return None
+        return dict(zip(("model", "cid", "turns", "last_used"), row))
+
+    def save(self, name: str, model: str, cid: str):
+        """同一 cid 轮数加一，换了 cid 就从 1 重新计数"""
+        now = time.time()
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(
+                "INSERT INTO threads VALUES (?, ?, ?, 1, ?, ?) ON CONFLICT(name) DO UPDATE SET"
+                " turns = CASE WHEN cid = excluded.cid THEN turns + 1 ELSE 1 END,"
+                " created_at = CASE WHEN cid = excluded.cid THEN created_at ELSE excluded.created_at END,"
+                " model = excluded.model, cid = excluded.cid, last_used = excluded.last_used",
+                (name, model, cid, now, now),
+            )
+            if self.max_age:
+                self.db.execute("DELETE FROM threads WHERE last_used < ?", (now - self.max_age,))
+            self.db.execute(
+                "DELETE FROM threads WHERE name NOT IN"
+                " (SELECT name FROM threads ORDER BY last_used DESC LIMIT ?)",
+                (self.max_threads,),
+            )
+
+    def close(self):
+        self.db.close()
+
+    def list(self) -> list:
+        rows = self.db.execute(
+            "SELECT name, model, cid, turns, last_used FROM threads ORDER BY last_used DESC"
+        ).fetchall()
+        return [dict(zip(("name", "model", "cid", "turns", "last_used"), row)) for row in rows]
+
+
 class GensparkCLI:
-    def __init__(self, cookies: str, model: str = "sonnet"):
+    def __init__(self, cookies: str, model: str = "sonnet", out=None):
         self.ws_url = "wss://vear.com/conversation/go"
         self.cookies = cookies
+        self.out = out or sys.stdout  # 流式输出写到这里；守护进程里换成发给客户端的帧
+        self.ping_interval = 0
+        self.timeout = 300  # 单条消息总等待上限 (秒)
+        self.idle_timeout = 30  # 多久没有新字符就放弃 (秒)
+        self.opened = threading.Event()  # 握手完成或失败
+        self.done = threading.Event()  # 当前请求结束 (t=n、错误或断线)
+        self.last_msg_time = time.monotonic()
+        self.error = None
         # Load uid from config if available
         try:
             cfg_path = Path("~/.config/genspark/config.json").expanduser()
@@ -32,6 +129,8 @@ class GensparkCLI:
         except:
             self.uid = self._generate_uid()
         self.cid = None
+        self.thread = "default"  # -c 使用的上下文线程名
+        self._contexts = None
         self.is_streaming = False
         self.connected = False
         self.response_text = ""
@@ -142,38 +241,75 @@ class GensparkCLI:
             if t == "s":
                 self.cid = data.get("cid")
                 self.is_streaming = True
-                self.last_msg_time = time.time()
+                self.last_msg_time = time.monotonic()
             elif t == "m":
                 content = data.get("c", "")
                 self.response_text += content
-                print(content, end="", flush=True)
-                self.last_msg_time = time.time()
+                self.out.write(content)
+                self.out.flush()
+                self.last_msg_time = time.monotonic()
             elif t == "n":
                 # 恢复正常结束信号，让程序在 AI 说完后立即退出
-                self.is_streaming = False
-                print()
+                self.out.write("\n")
+                self.out.flush()
+                self._finish()
             elif t in ("e", "err"):
                 error_msg = data.get("c", str(data))
                 print(f"\n[服务器错误] {error_msg}", file=sys.stderr)
-                self.is_streaming = False
+                self.error = error_msg
+                self._finish()
         except json.JSONDecodeError:
             # 如果不是 JSON，尝试直接打印，看看是不是服务器发了纯文本错误
             print(f"\n[收到非JSON数据] {message[:200]}...", file=sys.stderr)
         except Exception as e:
             print(f"\n[解析异常] {type(e).__name__}: {e}", file=sys.stderr)
-            self.is_streaming = False
+            self._finish()
     
     def _on_error(self, ws, error):
         print(f"\n[WS错误] 详细内容: {error}", file=sys.stderr)
-        self.is_streaming = False
+        self.error = str(error)
+        self.opened.set()
+        self._finish()
     
     def _on_close(self, ws, code, msg):
         print(f"\n[连接关闭] 代码: {code}, 原因: {msg}", file=sys.stderr)
         self.connected = False
-        self.is_streaming = False
+        self.opened.set()
+        self._finish()
     
     def _on_open(self, ws):
         self.connected = True
+        self.opened.set()
+    
+    def _finish(self):
+        self.is_streaming = False
+        self.done.set()
+    
+    def _start(self, payload: dict):
+        self.response_text = ""
+        self.error = None
+        self.is_streaming = True
+        self.last_msg_time = time.monotonic() # 初始化时间
+        self.done.clear()
+        self.ws.send(json.dumps(payload))
+    
+    def _wait(self, idle: float):
+        """等当前请求结束；idle 秒没有新字符或总时长超过 self.timeout 则放弃"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            now = time.monotonic()
+            remaining = min(self.last_msg_time + idle, deadline) - now
+            if remaining <= 0:
+                break
+            # 结束由 _on_message/_on_close 唤醒，不再轮询
+            if self.done.wait(remaining):
+                return
+        if now >= deadline:
+            self.error = f"超过 {self.timeout:g} 秒未完成"
+        else:
+            print(f"\n[超时] {idle:g}秒无新字符返回", file=sys.stderr)
+            self.error = f"{idle:g}秒无新字符返回"
+        self.is_streaming = False
     
     def connect(self):
         self.ws = websocket.WebSocketApp(
@@ -193,15 +329,15 @@ class GensparkCLI:
             on_open=self._on_open,
         )
         
-        t = threading.Thread(target=self.ws.run_forever)
+        t = threading.Thread(
+            target=self.ws.run_forever,
+            kwargs={"ping_interval": self.ping_interval} if self.ping_interval else {},
+        )
         t.daemon = True
+        self.opened.clear()
         t.start()
         
-        for _ in range(100):
-            if self.connected:
-                break
-            time.sleep(0.1)
-        
+        self.opened.wait(10)
         if not self.connected:
             raise Exception("连接超时")
     
@@ -214,6 +350,15 @@ class GensparkCLI:
         elif use_context:
             self._load_context()
         
+        self.response_text = self._ask(message)
+        
+        if use_context and self.cid:
+            self._save_context()
+        
+        return self.response_text
+    
+    def _ask(self, message: str) -> str:
+        """发一条消息并等回复结束，cid 沿用 self.cid"""
         model = self.models.get(self.current_model, self.models["opus"])
         payload = {
             "uid": self.uid,
@@ -227,56 +372,36 @@ class GensparkCLI:
         if self.cid:
             payload["cid"] = self.cid
         
-        self.response_text = ""
-        self.is_streaming = True
-        self.last_msg_time = time.time() # 初始化时间
-        self.ws.send(json.dumps(payload))
-        
-        while self.is_streaming:
-            time.sleep(0.1)
-            # 如果超过 30 秒没收一个新字，或者总等待超过 300 秒，才跳出
-            if time.time() - self.last_msg_time > 30:
-                print("\n[超时] 30秒无新字符返回", file=sys.stderr)
-                self.is_streaming = False
-                break
-            if time.time() - self.last_msg_time > 300: # 总保险
-                self.is_streaming = False
-                break
-        
-        if use_context and self.cid:
-            self._save_context()
-        
+        self._start(payload)
+        self._wait(self.idle_timeout)
         return self.response_text
     
-    def _context_path(self):
-        p = Path("~/.config/genspark").expanduser()
-        p.mkdir(parents=True, exist_ok=True)
-        return p / "context.json"
+    def _context_store(self) -> ContextStore:
+        # 每个实例只打开一次 (迁移和建表也只做一次)
+        if self._contexts is None:
+            self._contexts = ContextStore()
+        return self._contexts
     
     def _load_context(self):
-        cp = self._context_path()
-        if cp.exists():
-            try:
-                with open(cp) as f:
-                    ctx = json.load(f)
-                if ctx.get("model") == self.current_model:
-                    self.cid = ctx.get("cid")
-            except:
-                pass
+        try:
+            ctx = self._context_store().get(self.thread)
+        except sqlite3.Error as e:
+            print(f"[上下文] 读取失败: {e}", file=sys.stderr)
+            return
+        if ctx and ctx.get("model") == self.current_model:
+            self.cid = ctx.get("cid")
     
     def _save_context(self):
-        cp = self._context_path()
-        with open(cp, "w") as f:
-            json.dump({"cid": self.cid, "model": self.current_model, "ts": time.time()}, f)
+        try:
+            self._context_store().save(self.thread, self.current_model, self.cid)
+        except sqlite3.Error as e:
+            print(f"[上下文] 保存失败: {e}", file=sys.stderr)
     
     def generate_image(self, prompt: str) -> str:
         """Generate an image and return the URL"""
         if not self.connected:
             self.connect()
         
-        self.response_text = ""
-        self.is_streaming = True
-        
         payload = {
             "uid": self.uid,
             "mid": self._generate_mid(),
@@ -286,15 +411,15 @@ class GensparkCLI:
             "t": "i"
         }
         
-        self.ws.send(json.dumps(payload))
-        
-        while self.is_streaming:
-            time.sleep(0.1)
-        
+        self._start(payload)
+        # 出图前可能很久没有任何输出，空闲上限放宽到总时长
+        self._wait(self.timeout)
         return self.response_text.strip()
 
 
     def close(self):
+        if self._contexts is not None:
+            self._contexts.close()
         if hasattr(self, 'ws') and self.ws:
             self.ws.close()
         # 移除 os._exit(0)，防止清理过程太突兀导致最后的一点信息没打出来
@@ -302,6 +427,231 @@ class GensparkCLI:
         sys.exit(0)
 
 
+def daemon_socket_path() -> str:
+    return os.path.expanduser(os.environ.get("VEAR_SOCKET", "~/.config/genspark/vear.sock"))
+
+
+class DaemonClient(GensparkCLI):
+    """瘦客户端：请求交给本地守护进程，用它的热连接，接口与 GensparkCLI 相同
+
+    每个请求单独连一次 Unix socket，一行 JSON 请求，逐行收 JSON 帧:
+      {"t": "m", "c": 增量}  …  {"t": "n", "cid", "text", "error"?} 或 {"t": "e", "c": 错误}
+    """
+
+    def __init__(self, path: str, model: str = "sonnet", out=None):
+        super().__init__(cookies=None, model=model, out=out)
+        self.path = path
+
+    def connect(self):
+        self.connected = True
+
+    def _request(self, payload: dict) -> str:
+        self.response_text = ""
+        self.error = None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        with sock:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n")
+            with sock.makefile("r", encoding="utf-8") as f:
+                for line in f:
+                    frame = json.loads(line)
+                    if frame["t"] == "m":
+                        self.out.write(frame["c"])
+                        self.out.flush()
+                    elif frame["t"] == "n":
+                        self.cid = frame.get("cid") or self.cid
+                        self.error = frame.get("error")
+                        if self.error:
+                            print(f"\n[服务器错误] {self.error}", file=sys.stderr)
+                        self.response_text = frame.get("text", "")
+                        return self.response_text
+                    else:
+                        raise Exception(f"守护进程: {frame.get('c')}")
+        raise Exception("守护进程连接中断")
+
+    def _ask(self, message: str) -> str:
+        return self._request({"t": "m", "q": message, "model": self.current_model, "cid": self.cid})
+
+    def generate_image(self, prompt: str) -> str:
+        return self._request({"t": "i", "q": prompt}).strip()
+
+    def close(self):
+        # 没有自己的 WebSocket，不需要等清理
+        if self._contexts is not None:
+            self._contexts.close()
+        sys.exit(0)
+
+
+def connect_daemon(path: str, model: str):
+    """守护进程在线则返回 DaemonClient，否则 None (调用方直连)"""
+    if not os.path.exists(path):
+        return None
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        return None
+    finally:
+        probe.close()
+    return DaemonClient(path, model=model)
+
+
+class _FrameWriter:
+    """守护进程里代替 stdout：每段增量封装成一行 JSON 发给客户端"""
+
+    def __init__(self, conn: socket.socket):
+        self.conn = conn
+
+    def write(self, text: str):
+        if not text:
+            return
+        try:
+            self.conn.sendall(json.dumps({"t": "m", "c": text}, ensure_ascii=False).encode("utf-8") + b"\n")
+        except OSError:
+            pass  # 客户端已断开，仍把这次回复收完，连接才能复用
+
+    def flush(self):
+        pass
+
+
+class _NullWriter:
+    def write(self, text: str):
+        pass
+
+    def flush(self):
+        pass
+
+
+class VearDaemon:
+    """本地守护进程：保持 warm 条已握手的上游连接，空闲最多留 max_idle 条
+
+    每条连接同一时间只服务一个请求；cid 由客户端带来，请求之间互不影响。
+    连接断开 (含闲置时被上游关闭) 的在取用时丢弃，取用时若首发失败则换新连接重试一次。
+    """
+
+    def __init__(self, cookies: str, path: str, warm: int = 2, max_idle: int = 8):
+        self.cookies = cookies
+        self.path = path
+        self.warm = warm
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.refilling = False
+
+    def _new(self) -> GensparkCLI:
+        cli = GensparkCLI(self.cookies, out=_NullWriter())
+        cli.ping_interval = 30  # 闲置时保活
+        cli.connect()
+        return cli
+
+    def acquire(self) -> GensparkCLI:
+        with self.lock:
+            while self.idle:
+                cli = self.idle.pop()
+                if cli.connected:
+                    break
+            else:
+                cli = None
+        self._refill()
+        return cli or self._new()
+
+    def release(self, cli: GensparkCLI):
+        cli.out = _NullWriter()
+        # 超时放弃的回复还会继续到达，连接不能再给下一个请求用
+        if cli.connected and cli.done.is_set() and not cli.error:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(cli)
+                    return
+        cli.ws.close()
+
+    def _refill(self):
+        """后台补足预热连接，不占用请求线程"""
+        with self.lock:
+            if self.refilling or len(self.idle) >= self.warm:
+                return
+            self.refilling = True
+
+        def run():
+            try:
+                while len(self.idle) < self.warm:
+                    cli = self._new()
+                    with self.lock:
+                        self.idle.append(cli)
+            except Exception as e:
+                print(f"[守护进程] 预热连接失败: {e}", file=sys.stderr)
+            finally:
+                self.refilling = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def handle(self, conn: socket.socket, rfile):
+        line = rfile.readline()
+        if not line:
+            return
+        try:
+            req = json.loads(line)
+            for attempt in range(2):
+                cli = self.acquire()
+                try:
+                    cli.out = _FrameWriter(conn)
+                    cli.current_model = req.get("model") or "sonnet"
+                    cli.cid = req.get("cid")
+                    if req.get("t") == "i":
+                        text = cli.generate_image(req["q"])
+                    else:
+                        text = cli._ask(req["q"])
+                    frame = {"t": "n", "cid": cli.cid, "text": text}
+                    if cli.error:
+                        frame["error"] = cli.error
+                    break
+                except (websocket.WebSocketException, OSError):
+                    # 连接在闲置时已失效：换一条新连接重发
+                    cli.connected = False
+                    if attempt or cli.response_text:
+                        raise
+                finally:
+                    self.release(cli)
+        except Exception as e:
+            frame = {"t": "e", "c": f"{type(e).__name__}: {e}"}
+        try:
+            conn.sendall(json.dumps(frame, ensure_ascii=False).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+    def serve(self):
+        if os.path.exists(self.path):
+            if connect_daemon(self.path, "sonnet"):
+                raise Exception(f"守护进程已在运行: {self.path}")
+            os.unlink(self.path)  # 上次异常退出留下的 socket 文件
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.handle(self.connection, self.rfile)
+
+        server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        server.daemon_threads = True
+        os.chmod(self.path, 0o600)
+        signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+        self._refill()
+        print(f"[守护进程] 监听 {self.path}，预热 {self.warm} 条连接", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            for cli in self.idle:
+                cli.ws.close()
+
+
 def read_file(file_path: str) -> str:
     """读取文件内容"""
     path = Path(file_path).expanduser()
@@ -328,34 +678,202 @@ def read_file(file_path: str) -> str:
         return f.read()
 
 
+FILE_BUDGET_TOKENS = 120000  # -f 附加文件的默认 token 预算
+MMAP_THRESHOLD = 1 << 20  # 超过这个大小的文件用 mmap 按需读取，不整体载入
+_SNIFF_BYTES = 8192  # 开头这么多字节里有 NUL 即视为二进制
+_MIN_PIECE_TOKENS = 200  # 剩余预算不到这个数就不再放文件，只列出文件名
+_MAX_LISTED = 20
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略 token 数：ASCII 约 4 个字符 1 个，其余字符各算 1 个"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + len(text) - ascii_chars
+
+
+def iter_files(patterns: list):
+    """惰性产出 -f 匹配到的文件：先显式路径 (按给出顺序)，再逐个展开 glob；同一文件只出一次
+
+    文件名本身带 [ ] ? * 时 (如 page[1].py)，只要该路径存在就按字面路径处理，不当 glob 展开。
+    """
+    seen = set()
+    explicit = [p for p in patterns if not glob.has_magic(p) or os.path.isfile(os.path.expanduser(p))]
+    for pattern in explicit + [p for p in patterns if p not in explicit]:
+        if pattern in explicit:
+            matches = [pattern]
+        else:
+            matches = (m for m in glob.iglob(os.path.expanduser(pattern), recursive=True) if os.path.isfile(m))
+        for path in matches:
+            real = os.path.realpath(os.path.expanduser(path))
+            if real in seen:
+                continue
+            seen.add(real)
+            yield path
+
+
+def _clip(data, size: int, max_bytes: int):
+    """data 为 bytes 或 mmap；返回 (文本, 内容摘要)，二进制返回 (None, None)
+
+    超过 max_bytes 时保留开头 2/3、结尾 1/3，中间注明省略的字节数；
+    摘要按 1 MB 分块计算，mmap 时不会把整个文件读进内存。
+    """
+    if b"\0" in data[:_SNIFF_BYTES]:
+        return None, None
+    digest = hashlib.blake2b(digest_size=16)
+    for i in range(0, size, 1 << 20):
+        digest.update(data[i:i + (1 << 20)])
+    if size <= max_bytes:
+        return data[:size].decode("utf-8", errors="ignore"), digest.digest()
+    head, tail = max_bytes * 2 // 3, max_bytes // 3
+    text = (
+        data[:head].decode("utf-8", errors="ignore")
+        + f"\n... [省略 {size - head - tail} 字节] ...\n"
+        + data[size - tail:].decode("utf-8", errors="ignore")
+    )
+    return text, digest.digest()
+
+
+def load_file(path: str, max_bytes: int):
+    """读取文件供打包：返回 (文本, 字节数, 摘要)；大文件走 mmap，只取需要的片段"""
+    with open(Path(path).expanduser(), "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                text, digest = _clip(mm, size, max_bytes)
+        else:
+            text, digest = _clip(f.read(), size, max_bytes)
+    return text, size, digest
+
+
+def _trim(text: str, tokens: int) -> str:
+    """按估算 token 数再收紧 (多字节文字按字节读取时会超出预算)，保留首尾"""
+    total = estimate_tokens(text)
+    if total <= tokens:
+        return text
+    keep = len(text) * tokens // total
+    head, tail = keep * 2 // 3, keep // 3
+    return text[:head] + f"\n... [省略 {len(text) - head - tail} 字符] ...\n" + text[len(text) - tail:]
+
+
+def pack_files(patterns: list, budget: int = FILE_BUDGET_TOKENS) -> list:
+    """把 -f 匹配到的文件打包成 prompt 片段，总量不超过 budget (估算 token)
+
+    显式路径优先于 glob；二进制文件跳过，内容相同的只放一次；
+    单个文件最多占预算的一半，放不下的保留首尾。预算用完后剩余文件只列出名字。
+    """
+    parts = []
+    seen = {}
+    omitted = []
+    omitted_count = 0
+    remaining = budget
+    for path in iter_files(patterns):
+        if remaining < _MIN_PIECE_TOKENS:
+            omitted_count += 1
+            if len(omitted) < _MAX_LISTED:
+                omitted.append(path)
+            continue
+        cap = min(remaining, max(budget // 2, _MIN_PIECE_TOKENS))
+        try:
+            text, size, digest = load_file(path, cap * 4)
+        except Exception as e:
+            parts.append(f"\n--- {path} ---\n[读取失败: {e}]")
+            continue
+        if text is None:
+            parts.append(f"\n--- {path} ---\n[二进制文件，已跳过 ({size} 字节)]")
+            continue
+        if digest in seen:
+            parts.append(f"\n--- {path} ---\n[内容与 {seen[digest]} 相同，已省略]")
+            continue
+        seen[digest] = path
+        text = _trim(text, cap)
+        remaining -= estimate_tokens(text)
+        parts.append(f"\n--- {path} ---\n```\n{text}\n```")
+    if omitted_count:
+        more = f" 等 {omitted_count} 个" if omitted_count > len(omitted) else ""
+        parts.append(f"\n[超出 {budget} token 预算，未附加: {', '.join(omitted)}{more}]")
+    return parts
+
+
+class FileCache:
+    """@file 内容缓存：按真实路径存，(mtime, size) 变了即重新读取；总字符数超限时淘汰最久未用的
+
+    REPL 里每轮都引用同一批文件时不再重复读盘。
+    """
+
+    def __init__(self, max_chars: int = 16 << 20):
+        self.max_chars = max_chars
+        self._items = OrderedDict()  # 真实路径 -> (mtime_ns, size, content)
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def read(self, file_path: str) -> str:
+        real = os.path.realpath(os.path.expanduser(file_path))
+        try:
+            st = os.stat(real)
+        except OSError:
+            return read_file(file_path)  # 由 read_file 给出统一的错误信息
+        with self._lock:
+            item = self._items.get(real)
+            if item and item[:2] == (st.st_mtime_ns, st.st_size):
+                self._items.move_to_end(real)
+                return item[2]
+        content = read_file(file_path)
+        with self._lock:
+            old = self._items.pop(real, None)
+            if old:
+                self._chars -= len(old[2])
+            if len(content) <= self.max_chars:
+                self._items[real] = (st.st_mtime_ns, st.st_size, content)
+                self._chars += len(content)
+            while self._chars > self.max_chars:
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self._chars -= len(evicted)
+        return content
+
+
+file_cache = FileCache()
+
+
 def expand_file_references(text: str) -> str:
-    """展开文本中的 @file 引用"""
+    """展开文本中的 @file 引用 (引用多个文件时并发读取，内容经 file_cache 缓存)"""
     import re
+    from concurrent.futures import ThreadPoolExecutor
     
-    def replace_file_ref(match):
-        file_path = match.group(1)
+    # 匹配 @filepath 或 @"file path with spaces"
+    pattern = re.compile(r'@"([^"]+)"|@(\S+)')
+    paths = list(dict.fromkeys(m.group(1) or m.group(2) for m in pattern.finditer(text)))
+    if not paths:
+        return text
+    
+    def load(file_path):
         try:
-            content = read_file(file_path)
-            filename = Path(file_path).name
-            return f"\n\n--- {filename} ---\n```\n{content}\n```\n"
+            return file_cache.read(file_path)
         except Exception as e:
-            return f"\n[无法读取文件 {file_path}: {e}]\n"
+            return e
     
-    # 匹配 @filepath 或 @"file path with spaces"
-    pattern = r'@"([^"]+)"|@(\S+)'
+    if len(paths) == 1:
+        contents = {paths[0]: load(paths[0])}
+    else:
+        with ThreadPoolExecutor(max_workers=min(8, len(paths))) as pool:
+            contents = dict(zip(paths, pool.map(load, paths)))
     
     def replacer(match):
         file_path = match.group(1) or match.group(2)
-        return replace_file_ref(type('Match', (), {'group': lambda self, x: file_path})())
+        content = contents[file_path]
+        if isinstance(content, Exception):
+            return f"\n[无法读取文件 {file_path}: {content}]\n"
+        filename = Path(file_path).name
+        return f"\n\n--- {filename} ---\n```\n{content}\n```\n"
     
-    return re.sub(pattern, replacer, text)
+    return pattern.sub(replacer, text)
 
 
 def build_prompt(
     message: str,
     files: list = None,
     system_prompt: str = None,
-    template: str = None
+    template: str = None,
+    budget: int = FILE_BUDGET_TOKENS
 ) -> str:
     """构建完整的 prompt"""
     parts = []
@@ -371,26 +889,10 @@ def build_prompt(
             template_content = read_file(template)
             parts.append(f"[Template]\n{template_content}\n")
     
-    # 文件内容
+    # 文件内容 (支持 glob，按预算打包)
     if files:
         parts.append("[Files]")
-        for file_path in files:
-            # 支持 glob 模式
-            if '*' in file_path:
-                matched_files = glob.glob(file_path, recursive=True)
-                for f in matched_files:
-                    if os.path.isfile(f):
-                        try:
-                            content = read_file(f)
-                            parts.append(f"\n--- {f} ---\n```\n{content}\n```")
-                        except Exception as e:
-                            parts.append(f"\n--- {f} ---\n[读取失败: {e}]")
-            else:
-                try:
-                    content = read_file(file_path)
-                    parts.append(f"\n--- {file_path} ---\n```\n{content}\n```")
-                except Exception as e:
-                    parts.append(f"\n--- {file_path} ---\n[读取失败: {e}]")
+        parts.extend(pack_files(files, budget))
         parts.append("")
     
     # 展开消息中的 @file 引用
@@ -402,6 +904,267 @@ def build_prompt(
     return "\n".join(parts)
 
 
+def batch_items(f):
+    """逐行读取已打开的批量输入：JSON 对象或一行一个 prompt，空行跳过；读完关闭 (stdin 除外)
+
+    JSON 行可带 id / prompt (或 message) / model / system / files。
+    """
+    try:
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = None
+            if line.startswith("{"):
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    pass
+            if not isinstance(item, dict):
+                item = {"prompt": line}
+            item["index"] = index
+            index += 1
+            yield item
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class BatchRunner:
+    """批量执行：concurrency 个线程各持一条连接，每条 prompt 开新对话
+
+    输入按需读取，在途条目不超过 2 × concurrency；结果按 JSONL 写到 out，
+    ordered 时按输入顺序输出 (先完成的暂存)，否则谁先完成先输出。
+    失败 (异常、上游错误、超时) 会换一条新连接重试，间隔指数退避。
+    """
+
+    def __init__(self, make_client, args, concurrency: int = 4, retries: int = 2,
+                 timeout: float = 120, ordered: bool = True, out=None):
+        self.make_client = make_client
+        self.args = args
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.timeout = timeout
+        self.ordered = ordered
+        self.out = out or sys.stdout
+        self.local = threading.local()
+        self.clients = []
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_index = 0
+        self.done = 0
+        self.failed = 0
+        self.chars = 0
+
+    def _client(self) -> GensparkCLI:
+        cli = getattr(self.local, "cli", None)
+        if cli is None:
+            cli = self.make_client()
+            cli.out = _NullWriter()
+            cli.timeout = self.timeout
+            cli.connect()
+            self.local.cli = cli
+            with self.lock:
+                self.clients.append(cli)
+        return cli
+
+    def _drop_client(self):
+        # 超时或出错后连接上可能还有上一条的残余帧，不再复用
+        cli = getattr(self.local, "cli", None)
+        self.local.cli = None
+        if cli is not None and getattr(cli, "ws", None):
+            cli.ws.close()
+
+    def _run(self, item: dict) -> dict:
+        model = item.get("model") or self.args.model
+        result = {"index": item["index"], "id": item.get("id"), "model": model}
+        started = time.time()
+        prompt = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.0))
+            try:
+                if prompt is None:
+                    try:
+                        prompt = build_prompt(
+                            item.get("prompt") or item.get("message") or "",
+                            files=item.get("files"),
+                            system_prompt=item.get("system") or self.args.system,
+                            template=self.args.template,
+                            budget=self.args.budget,
+                        )
+                    except Exception as e:
+                        # 条目本身有问题，重试也没用，也不必丢弃连接
+                        result.update(response=None, error=f"{type(e).__name__}: {e}")
+                        break
+                cli = self._client()
+                cli.current_model = model
+                cli.cid = None
+                response = cli._ask(prompt)
+                if cli.error:
+                    raise Exception(cli.error)
+                result.update(response=response, error=None)
+                break
+            except Exception as e:
+                self._drop_client()
+                result.update(response=None, error=f"{type(e).__name__}: {e}")
+        result["attempts"] = attempt + 1
+        result["elapsed"] = round(time.time() - started, 3)
+        return result
+
+    def _done(self, future, item: dict, slots):
+        try:
+            try:
+                result = future.result()
+            except BaseException as e:
+                # 兜底：任何条目都要有一条结果，否则按序输出会卡住
+                result = {"index": item["index"], "id": item.get("id"), "model": item.get("model") or self.args.model,
+                          "response": None, "error": f"{type(e).__name__}: {e}", "attempts": 0, "elapsed": 0}
+            self._emit(result)
+        finally:
+            slots.release()
+
+    def _emit(self, result: dict):
+        with self.lock:
+            self.done += 1
+            if result["error"]:
+                self.failed += 1
+            else:
+                self.chars += len(result["response"])
+            if not self.ordered:
+                self._write(result)
+                return
+            self.pending[result["index"]] = result
+            while self.next_index in self.pending:
+                self._write(self.pending.pop(self.next_index))
+                self.next_index += 1
+
+    def _write(self, result: dict):
+        self.out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.out.flush()
+
+    def run(self, items) -> bool:
+        from concurrent.futures import ThreadPoolExecutor
+        
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for item in items:
+                slots.acquire()
+                future = pool.submit(self._run, item)
+                future.add_done_callback(lambda f, item=item: self._done(f, item, slots))
+        for cli in self.clients:
+            if getattr(cli, "ws", None):
+                cli.ws.close()
+        elapsed = max(time.time() - started, 1e-6)
+        print(
+            f"[批量] 完成 {self.done} 条，失败 {self.failed} 条，用时 {elapsed:.1f}s，"
+            f"{self.done / elapsed:.2f} 条/秒，{self.chars / elapsed:.0f} 字符/秒",
+            file=sys.stderr,
+        )
+        return self.failed == 0
+
+
+class HistoryClient:
+    """对话历史 API (/api/history/{uid})：http.client 长连接，每个线程一条
+
+    列表按页取完 (HpS 每页条数、HcP 页码)；网络错误、429 和 5xx 按指数退避重试。
+    """
+
+    def __init__(self, uid: str, cookies: str, base_url: str = "https://vear.com",
+                 retries: int = 3, timeout: float = 30):
+        from urllib.parse import urlsplit
+        
+        url = urlsplit(base_url)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.base = f"/api/history/{uid}"
+        self.headers = {
+            "Cookie": cookies,
+            "Origin": "https://vear.com",
+            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+        }
+        self.retries = retries
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _conn(self):
+        import http.client
+        
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = self.local.conn = cls(self.host, timeout=self.timeout)
+        return conn
+
+    def _request(self, method: str, path: str, body: dict = None):
+        """返回 (状态码, 响应体)；重试用尽后返回最后一次的结果或抛出最后的异常"""
+        import http.client
+        
+        headers = dict(self.headers)
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(min(0.5 * 2 ** (attempt - 1), 10) * random.uniform(0.5, 1.0))
+            conn = self._conn()
+            try:
+                conn.request(method, self.base + path, body=data, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+            except (OSError, http.client.HTTPException):
+                # 长连接被对端关掉等：丢弃后重连
+                conn.close()
+                self.local.conn = None
+                if attempt == self.retries:
+                    raise
+                continue
+            if resp.status == 429 or resp.status >= 500:
+                if attempt < self.retries:
+                    continue
+            return resp.status, payload
+
+    def page(self, page: int, size: int = 100) -> list:
+        status, payload = self._request("POST", "", {"HcP": page, "HpS": size})
+        if status != 200:
+            raise Exception(f"获取历史失败: HTTP {status}")
+        data = json.loads(payload) if payload.strip() else {}
+        return data.get("conversations") or []
+
+    def iter_all(self, size: int = 100, max_pages: int = 1000):
+        seen = set()
+        for page in range(1, max_pages + 1):
+            convos = [c for c in self.page(page, size) if c["id"] not in seen]
+            # 不足一页或整页都见过 (页码被忽略) 时结束
+            if not convos:
+                return
+            for c in convos:
+                seen.add(c["id"])
+                yield c
+            if len(convos) < size:
+                return
+
+    def delete(self, cid: str) -> int:
+        return self._request("DELETE", f"/{cid}")[0]
+
+    def delete_many(self, cids: list, concurrency: int = 8):
+        """并发删除，产出 (cid, 状态码)；网络异常记为状态码 0"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        def delete(cid):
+            try:
+                return cid, self.delete(cid)
+            except Exception as e:
+                print(f"[删除失败] {cid}: {e}", file=sys.stderr)
+                return cid, 0
+        
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            yield from pool.map(delete, cids)
+
+
 def repl(cli: GensparkCLI, system_prompt: str = None):
     """交互式 REPL"""
     print(f"🚀 Genspark CLI - {cli.current_model.upper()}")
@@ -517,6 +1280,8 @@ def main():
   # 上下文模式 (多轮对话复用同一个会话)
   vear -c "我叫小明"
   vear -c "我叫什么?"
+  vear --thread review "看看这个 PR"   # 命名线程，可并行使用多条
+  vear --threads                      # 列出保存的线程
 
   # 生成图片
   vear -i "a cyberpunk cat with neon glasses"
@@ -526,6 +1291,7 @@ def main():
   vear -f main.py "解释这段代码"
   vear -f "src/*.py" "检查代码风格"
   vear "比较 @file1.py 和 @file2.py"
+  vear -f "src/**/*.py" --budget 50000 "概述架构"   # 大目录按预算打包
 
   # 管道输入
   cat error.log | vear "分析这个错误"
@@ -543,6 +1309,14 @@ def main():
   vear --raw -m haiku "say yes"   # 纯文本输出
   vear --json "列出建议"           # JSON 输出
 
+  # 守护进程 (脚本里反复调用时省掉每次握手)
+  vear --daemon &                 # 常驻，之后的 vear 自动经由它发送
+  vear --no-daemon "直连"          # 不使用守护进程
+
+  # 批量 (JSONL 或一行一个 prompt，结果为 JSONL)
+  vear --batch prompts.txt -m haiku > results.jsonl
+  cat items.jsonl | vear --batch - --concurrency 8 --unordered
+
 可用模型:
   opus (默认)    Claude 4.6 Opus      | sonnet    Claude 4.6 Sonnet
   opus-4.5       Claude 4.5 Opus      | sonnet-4.5 Claude 4.5 Sonnet
@@ -558,6 +1332,8 @@ def main():
     parser.add_argument("-f", "--file", action="append", dest="files", help="附加文件 (可多次使用，支持 glob)")
     parser.add_argument("-s", "--system", help="系统提示")
     parser.add_argument("-t", "--template", help="提示模板文件")
+    parser.add_argument("--budget", type=int, default=FILE_BUDGET_TOKENS,
+                        help=f"-f 附加文件的 token 预算 (默认 {FILE_BUDGET_TOKENS}，超出的截断或省略)")
     parser.add_argument("-m", "--model", default="sonnet", help="模型 (opus/sonnet/haiku/gpt5/gemini/grok)")
     parser.add_argument("-n", "--new", action="store_true", help="强制新对话")
     parser.add_argument("--json", action="store_true", help="JSON 格式输出 (用于自动化)")
@@ -567,6 +1343,15 @@ def main():
     parser.add_argument("--delete", metavar="CID", help="删除指定对话")
     parser.add_argument("-i", "--image", action="store_true", help="生成图片模式")
     parser.add_argument("-c", "--continue", dest="continue_chat", action="store_true", help="继续上次对话")
+    parser.add_argument("--thread", metavar="NAME", help="-c 使用的命名对话线程 (默认 default，指定即隐含 -c)")
+    parser.add_argument("--threads", action="store_true", help="列出保存的对话线程")
+    parser.add_argument("--daemon", action="store_true", help="以守护进程运行，保持预热连接 (Unix socket: $VEAR_SOCKET)")
+    parser.add_argument("--no-daemon", action="store_true", help="不使用守护进程，直接连接")
+    parser.add_argument("--batch", metavar="FILE", help="批量模式: JSONL 或一行一个 prompt ('-' 为 stdin)")
+    parser.add_argument("--concurrency", type=int, default=4, help="批量并发数 (默认 4)；--clean 按其 2 倍并发删除")
+    parser.add_argument("--retries", type=int, default=2, help="批量每条失败重试次数 (默认 2)")
+    parser.add_argument("--item-timeout", type=float, default=120, help="批量每条超时秒数 (默认 120)")
+    parser.add_argument("--unordered", action="store_true", help="批量结果按完成顺序输出")
     
     args = parser.parse_args()
     
@@ -585,7 +1370,46 @@ def main():
         print("  export GENSPARK_COOKIES='你的cookie'", file=sys.stderr)
         sys.exit(1)
     
-    cli = GensparkCLI(cookies=cookies, model=args.model)
+    if args.daemon:
+        try:
+            VearDaemon(cookies, daemon_socket_path(), warm=int(os.environ.get("VEAR_DAEMON_WARM", 2))).serve()
+        except Exception as e:
+            print(f"错误: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+    
+    if args.batch:
+        # 先打开输入，文件不存在时直接报错退出，不必先连上游
+        try:
+            batch_input = sys.stdin if args.batch == "-" else open(Path(args.batch).expanduser(), encoding="utf-8")
+        except OSError as e:
+            print(f"错误: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    cli = None if args.no_daemon else connect_daemon(daemon_socket_path(), args.model)
+    if cli is None:
+        cli = GensparkCLI(cookies=cookies, model=args.model)
+    
+    if args.batch:
+        daemon = isinstance(cli, DaemonClient)
+        runner = BatchRunner(
+            (lambda: DaemonClient(cli.path, model=args.model)) if daemon
+            else (lambda: GensparkCLI(cookies=cookies, model=args.model)),
+            args,
+            concurrency=args.concurrency,
+            retries=args.retries,
+            timeout=args.item_timeout,
+            ordered=not args.unordered,
+        )
+        sys.exit(0 if runner.run(batch_items(batch_input)) else 1)
+    
+    if args.threads:
+        store = ContextStore()
+        for t in store.list():
+            used = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t["last_used"]))
+            print(f"{t['name']}  {t['model']}  {t['turns']} 轮  {used}  {t['cid']}")
+        store.close()
+        return
     
     # 检查管道输入
     stdin_content = ""
@@ -600,44 +1424,32 @@ def main():
         else:
             message = stdin_content
     
+    if args.thread:
+        cli.thread = args.thread
+        args.continue_chat = True
+    
     # 管理命令
     if args.history or args.clean or args.delete:
-        import subprocess
         with open(Path("~/.config/genspark/config.json").expanduser()) as f:
             cfg = json.load(f)
-        cookies_val = cfg['cookies']
-        uid_val = cfg.get('uid', 'unknown')
-        base = f'https://vear.com/api/history/{uid_val}'
+        api = HistoryClient(cfg.get('uid', 'unknown'), cfg['cookies'])
         
         if args.history:
-            r = subprocess.run(['curl','-s',base,'-H','content-type: application/json',
-                '-b',cookies_val,'-H','origin: https://vear.com',
-                '--data-raw',json.dumps({"HcP":1,"HpS":20})],capture_output=True,text=True)
-            data = json.loads(r.stdout) if r.stdout.strip() else {}
-            for c in (data.get('conversations') or []):
-                msg = c.get('Messages',[{}])[0].get('content','')[:60]
+            for c in api.iter_all():
+                msg = (c.get('Messages') or [{}])[0].get('content','')[:60]
                 ts = c.get('created_at','')[:19]
                 print(f"{c['id']}  {ts}  {msg}")
             return
         
         if args.delete:
-            r = subprocess.run(['curl','-s','-o','/dev/null','-w','%{http_code}','-X','DELETE',
-                f"{base}/{args.delete}",'-b',cookies_val,'-H','origin: https://vear.com'],
-                capture_output=True,text=True)
-            print(f"Delete {args.delete}: {r.stdout}")
+            print(f"Delete {args.delete}: {api.delete(args.delete)}")
             return
         
         if args.clean:
-            r = subprocess.run(['curl','-s',base,'-H','content-type: application/json',
-                '-b',cookies_val,'-H','origin: https://vear.com',
-                '--data-raw',json.dumps({"HcP":1,"HpS":100})],capture_output=True,text=True)
-            data = json.loads(r.stdout) if r.stdout.strip() else {}
-            convos = data.get('conversations') or []
-            for c in convos:
-                subprocess.run(['curl','-s','-o','/dev/null','-X','DELETE',
-                    f"{base}/{c['id']}",'-b',cookies_val,'-H','origin: https://vear.com'],
-                    capture_output=True)
-            print(f"Cleaned {len(convos)} conversations")
+            # 先取全部 id 再删，边翻页边删会让后面的页错位
+            cids = [c['id'] for c in api.iter_all()]
+            failed = [cid for cid, status in api.delete_many(cids, args.concurrency * 2) if not 200 <= status < 300]
+            print(f"Cleaned {len(cids) - len(failed)} conversations" + (f", {len(failed)} failed" if failed else ""))
             return
 
         # 交互模式
@@ -653,7 +1465,8 @@ def main():
             message or "请分析以下文件",
             files=args.files,
             system_prompt=args.system,
-            template=args.template
+            template=args.template,
+            budget=args.budget
         )
         
         # Image generation mode